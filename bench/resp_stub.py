@@ -0,0 +1,152 @@
+"""
+In-process stand-in for a Redis server, so the redis:// state backend can be
+benchmarked (and exercised) without one. Speaks RESP2 and implements just the
+commands main.RedisBackend sends, with millisecond expiry:
+
+    PING, AUTH, SELECT, GET, SET [PX ms] [NX], DEL, INCRBY, PTTL, SCAN
+
+    server = start_resp_stub()
+    os.environ["STATE_BACKEND"] = f"redis://127.0.0.1:{server.server_address[1]}/0"
+"""
+import fnmatch
+import socketserver
+import threading
+import time
+
+
+class RespStubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, _RespHandler)
+        self.data: dict[bytes, tuple[bytes, float | None]] = {}  # key -> (value, expires_at)
+        self.lock = threading.Lock()
+        self.commands: dict[str, int] = {}
+        self.errors = 0
+
+    def live(self, key: bytes) -> tuple[bytes, float | None] | None:
+        """Entry for `key` unless it has expired (caller holds the lock)."""
+        item = self.data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return item
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"keys": len(self.data), "commands": dict(self.commands), "errors": self.errors}
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    server: RespStubServer
+    disable_nagle_algorithm = True  # Pipelined replies go out as separate writes
+
+    def handle(self):
+        while True:
+            try:
+                args = self._read_command()
+            except (ConnectionError, ValueError):
+                return
+            if args is None:
+                return
+            self.wfile.write(self._dispatch(args))
+
+    def _read_command(self) -> list[bytes] | None:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            raise ValueError("inline commands are not supported")
+        args = []
+        for _ in range(int(line[1:-2])):
+            size = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def _dispatch(self, args: list[bytes]) -> bytes:
+        name = args[0].decode().upper()
+        server = self.server
+        with server.lock:
+            server.commands[name] = server.commands.get(name, 0) + 1
+            handler = getattr(self, "_cmd_" + name.lower(), None)
+            if handler is None:
+                server.errors += 1
+                return b"-ERR unknown command '%s'\r\n" % name.encode()
+            try:
+                return handler(args[1:])
+            except (IndexError, ValueError) as e:
+                server.errors += 1
+                return b"-ERR %s\r\n" % str(e).encode()
+
+    # --- Replies ---
+
+    @staticmethod
+    def _bulk(value: bytes | None) -> bytes:
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+    @staticmethod
+    def _int(value: int) -> bytes:
+        return b":%d\r\n" % value
+
+    # --- Commands (called with the server lock held) ---
+
+    def _cmd_ping(self, args):
+        return b"+PONG\r\n"
+
+    def _cmd_auth(self, args):
+        return b"+OK\r\n"
+
+    def _cmd_select(self, args):
+        return b"+OK\r\n"
+
+    def _cmd_get(self, args):
+        item = self.server.live(args[0])
+        return self._bulk(None if item is None else item[0])
+
+    def _cmd_set(self, args):
+        key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+        expires_at = None
+        if b"PX" in options:
+            expires_at = time.monotonic() + int(args[2 + options.index(b"PX") + 1]) / 1000
+        if b"NX" in options and self.server.live(key) is not None:
+            return b"$-1\r\n"
+        self.server.data[key] = (value, expires_at)
+        return b"+OK\r\n"
+
+    def _cmd_del(self, args):
+        removed = 0
+        for key in args:
+            if self.server.live(key) is not None:
+                del self.server.data[key]
+                removed += 1
+        return self._int(removed)
+
+    def _cmd_incrby(self, args):
+        key, amount = args[0], int(args[1])
+        item = self.server.live(key)
+        value = (int(item[0]) if item else 0) + amount
+        self.server.data[key] = (str(value).encode(), item[1] if item else None)
+        return self._int(value)
+
+    def _cmd_pttl(self, args):
+        item = self.server.live(args[0])
+        if item is None:
+            return self._int(-2)
+        if item[1] is None:
+            return self._int(-1)
+        return self._int(max(int((item[1] - time.monotonic()) * 1000), 0))
+
+    def _cmd_scan(self, args):
+        # The whole keyspace in one pass: cursor 0 in, cursor 0 out
+        options = [a.upper() for a in args[1:]]
+        pattern = args[1 + options.index(b"MATCH") + 1].decode() if b"MATCH" in options else "*"
+        keys = [k for k in list(self.server.data) if self.server.live(k) and fnmatch.fnmatchcase(k.decode(), pattern)]
+        return b"*2\r\n" + self._bulk(b"0") + b"*%d\r\n" % len(keys) + b"".join(self._bulk(k) for k in keys)
+
+
+def start_resp_stub(host: str = "127.0.0.1", port: int = 0) -> RespStubServer:
+    """Start the stand-in on a background thread; `server_address` holds the bound port."""
+    server = RespStubServer((host, port))
+    threading.Thread(target=server.serve_forever, name="resp-stub", daemon=True).start()
+    return server
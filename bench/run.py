@@ -0,0 +1,315 @@
+"""
+Offline benchmark for /extract.
+
+Serves recorded upstream responses (bench/fixtures) from a local HTTP server,
+lets yt-dlp pick up fake extractors for bench.invalid, Instagram and TikTok
+URLs (bench/yt_dlp_plugins) and drives /extract through the app's ASGI stack,
+so no request leaves the machine. Each scenario runs in a fresh process so its
+caches and peak RSS are its own. The redis_state scenario keeps the app's
+shared state on an in-process RESP stand-in (bench/resp_stub.py).
+
+    python bench/run.py --requests 500 --concurrency 16 --output bench-2.0.0.json
+
+Needs httpx on top of requirements.txt. Extra environment variables (e.g.
+EXTRACT_EXECUTOR=process) are passed through to the app under test.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+FIXTURES_DIR = BENCH_DIR / "fixtures"
+
+SCENARIOS = (
+    "cache_hit", "ytdlp_success", "instagram_fallback", "carousel",
+    "instagram_fast_path", "tiktok_fast_path", "redis_state",
+)
+# Settings a scenario needs on top of the defaults in run_scenario()
+SCENARIO_ENV = {
+    "instagram_fallback": {"FAST_PATHS": "none"},  # yt-dlp fails, then the IG API race
+}
+
+
+# =====================
+# Fake Upstream
+# =====================
+
+class _UpstreamHandler(BaseHTTPRequestHandler):
+    """Answers like Instagram's API/page/oEmbed, TikTok's post page and a yt-dlp-backed site."""
+
+    fixtures: dict[str, bytes] = {}
+    latency = 0.0
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path.startswith("/api/v1/oembed/"):
+            name, content_type = "instagram_oembed.json", "application/json"
+        elif path.startswith("/p/REEL") and "__a=1" in query:
+            name, content_type = "instagram_reel.json", "application/json"
+        elif path.startswith("/p/"):
+            if "__a=1" in query:
+                name, content_type = "instagram_post.json", "application/json"
+            else:
+                name, content_type = "instagram_post.html", "text/html; charset=utf-8"
+        elif path.startswith("/@"):
+            name, content_type = "tiktok_video.html", "text/html; charset=utf-8"
+        elif path.startswith("/ytdlp/"):
+            name, content_type = f"ytdlp_{path[len('/ytdlp/'):]}", "application/json"
+        else:
+            name, content_type = None, None
+
+        body = self.fixtures.get(name)
+        if body is None:
+            self.send_error(404)
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if name.startswith("tiktok_"):
+            self.send_header("Set-Cookie", "tt_chain_token=bench; Path=/; Domain=127.0.0.1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_upstream(latency_ms: float) -> ThreadingHTTPServer:
+    _UpstreamHandler.fixtures = {path.name: path.read_bytes() for path in FIXTURES_DIR.iterdir()}
+    _UpstreamHandler.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _UpstreamHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bench-upstream", daemon=True).start()
+    return server
+
+
+# =====================
+# Scenario Runner (child process)
+# =====================
+
+def _scenario_urls(scenario: str, count: int) -> list[str]:
+    # Unique URLs everywhere but cache_hit so the result cache never answers
+    if scenario == "cache_hit":
+        return ["https://bench.invalid/video/cached"] * count
+    if scenario in ("ytdlp_success", "redis_state"):
+        return [f"https://bench.invalid/video/v{i:06d}" for i in range(count)]
+    if scenario == "instagram_fallback":
+        return [f"https://www.instagram.com/p/BENCH{i:06d}/" for i in range(count)]
+    if scenario == "carousel":
+        return [f"https://bench.invalid/carousel/c{i:06d}" for i in range(count)]
+    if scenario == "instagram_fast_path":
+        # Alternate image carousels and reels
+        return [
+            f"https://www.instagram.com/reel/REEL{i:06d}/" if i % 2 else f"https://www.instagram.com/p/POST{i:06d}/"
+            for i in range(count)
+        ]
+    if scenario == "tiktok_fast_path":
+        return [f"https://www.tiktok.com/@bench/video/{7300000000000000000 + i}" for i in range(count)]
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+def _peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    ms = sorted(value * 1000 for value in latencies)
+    if len(ms) >= 2:
+        cuts = statistics.quantiles(ms, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = ms[0] if ms else None
+    return {
+        "requests": len(ms) + errors,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(ms) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": None if p50 is None else round(p50, 2),
+            "p95": None if p95 is None else round(p95, 2),
+            "p99": None if p99 is None else round(p99, 2),
+            "mean": round(statistics.fmean(ms), 2) if ms else None,
+            "max": round(ms[-1], 2) if ms else None,
+        },
+    }
+
+
+async def _drive(main, scenario: str, count: int, concurrency: int) -> dict:
+    import httpx
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), \
+            httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        while (await client.get("/ready")).status_code != 200:
+            await asyncio.sleep(0.05)
+        if scenario == "cache_hit":
+            primed = await client.post("/extract", json={"url": _scenario_urls(scenario, 1)[0]})
+            primed.raise_for_status()
+
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies: list[float] = []
+        failures: dict[str, int] = {}
+        served_by: dict[str, int] = {}
+
+        async def one(url: str):
+            async with semaphore:
+                started = time.perf_counter()
+                resp = await client.post("/extract", json={"url": url})
+                if resp.status_code == 200:
+                    latencies.append(time.perf_counter() - started)
+                    path = resp.json().get("served_by") or "unknown"
+                    served_by[path] = served_by.get(path, 0) + 1
+                else:
+                    failures[str(resp.status_code)] = failures.get(str(resp.status_code), 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(url) for url in _scenario_urls(scenario, count)))
+        elapsed = time.perf_counter() - started
+
+    result = _summarize(latencies, sum(failures.values()), elapsed)
+    result["failures"] = failures
+    result["served_by"] = served_by
+    result["peak_rss_mb"] = _peak_rss_mb()
+    result["app_version"] = main.app.version
+    return result
+
+
+def run_scenario(args) -> dict:
+    upstream = _start_upstream(args.upstream_latency_ms)
+    base_url = f"http://127.0.0.1:{upstream.server_port}"
+    os.environ["BENCH_UPSTREAM_URL"] = base_url
+    os.environ["INSTAGRAM_BASE_URL"] = base_url
+    os.environ["TIKTOK_BASE_URL"] = base_url
+    os.environ.setdefault("EXTRACT_RATE_LIMIT", "1000000/minute")
+    resp_stub = None
+    if args.scenario == "redis_state":
+        from resp_stub import start_resp_stub
+
+        resp_stub = start_resp_stub()
+        os.environ["STATE_BACKEND"] = f"redis://127.0.0.1:{resp_stub.server_address[1]}/0"
+    os.environ.setdefault("STATE_BACKEND", "memory://")
+    # A fresh link index, so earlier runs can't warm this one
+    os.environ.setdefault("LINK_INDEX_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-"), "links.sqlite3"))
+    for key, value in SCENARIO_ENV.get(args.scenario, {}).items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(1, str(REPO_DIR))
+
+    import main
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    try:
+        result = asyncio.run(_drive(main, args.scenario, args.requests, args.concurrency))
+    finally:
+        upstream.shutdown()
+        if resp_stub is not None:
+            resp_stub.shutdown()
+    if resp_stub is not None:
+        # Shows the app really used the backend (the limiter silently falls back to memory)
+        result["state_backend"] = resp_stub.stats()
+    return result
+
+
+# =====================
+# Entry Point
+# =====================
+
+def _git_revision() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, timeout=10,
+        )
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline /extract benchmark.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight")
+    parser.add_argument("--upstream-latency-ms", type=float, default=0.0,
+                        help="Delay added to every fake-upstream response")
+    parser.add_argument("--output", default="bench-results.json", help="Where to write the JSON report")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's log output")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)  # Child-process mode
+    args = parser.parse_args()
+
+    if args.scenario:
+        print(json.dumps(run_scenario(args)))
+        return
+
+    if importlib.util.find_spec("httpx") is None:
+        parser.error("httpx is required (pip install httpx)")
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "upstream_latency_ms": args.upstream_latency_ms,
+            "extract_executor": os.getenv("EXTRACT_EXECUTOR", "thread"),
+        },
+        "scenarios": {},
+    }
+    for scenario in scenarios:
+        child = subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), "--scenario", scenario,
+             "--requests", str(args.requests), "--concurrency", str(args.concurrency),
+             "--upstream-latency-ms", str(args.upstream_latency_ms)]
+            + (["--verbose"] if args.verbose else []),
+            capture_output=True, text=True,
+        )
+        if args.verbose or child.returncode:
+            sys.stderr.write(child.stderr)
+        if child.returncode:
+            report["scenarios"][scenario] = {"error": f"exited with status {child.returncode}"}
+            continue
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        report["scenarios"][scenario] = result
+        latency = result["latency_ms"]
+        print(f"{scenario:<20} {result['throughput_rps']!s:>9} req/s  "
+              f"p50 {latency['p50']}ms  p95 {latency['p95']}ms  p99 {latency['p99']}ms  "
+              f"rss {result['peak_rss_mb']}MB  errors {result['errors']}")
+
+    Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Fake extractors for the offline benchmark (loaded by yt-dlp's plugin system
+when bench/ is on sys.path). They read recorded info dicts from the local
+stub server instead of talking to real sites.
+"""
+import os
+
+from yt_dlp.extractor.common import InfoExtractor
+from yt_dlp.utils import ExtractorError
+
+UPSTREAM = os.getenv("BENCH_UPSTREAM_URL", "http://127.0.0.1:8799")
+
+
+class BenchUpstreamIE(InfoExtractor):
+    IE_NAME = 'bench:upstream'
+    _VALID_URL = r'https?://bench\.invalid/(?P<kind>video|carousel)/(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        kind, media_id = self._match_valid_url(url).group('kind', 'id')
+        info = self._download_json(f'{UPSTREAM}/ytdlp/{kind}.json', media_id)
+        for index, entry in enumerate(info.get('entries') or (), 1):
+            entry['id'] = f'{media_id}-{index}'
+        return {**info, 'id': media_id, 'webpage_url': url}
+
+
+class BenchInstagramIE(InfoExtractor):
+    """Stands in for yt-dlp's Instagram extractor failing on an image post."""
+    IE_NAME = 'bench:instagram'
+    _VALID_URL = r'https?://(?:www\.)?instagram\.com/(?:[^/]+/)?(?:p|reel|reels|tv)/(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        raise ExtractorError('There is no video in this post', expected=True)
+
+
+class BenchTikTokIE(InfoExtractor):
+    """Keeps yt-dlp's TikTok extractor off the network if the fast path misses."""
+    IE_NAME = 'bench:tiktok'
+    _VALID_URL = r'https?://(?:www\.)?tiktok\.com/@[^/]+/(?:video|photo)/(?P<id>\d+)'
+
+    def _real_extract(self, url):
+        raise ExtractorError('Unable to extract webpage video data', expected=True)
@@ -1,17 +1,47 @@
+from __future__ import annotations
+
+import time
+
+_IMPORT_STARTED = time.perf_counter()  # Startup timing covers the imports below
+
 import os
 import re
+import asyncio
 import logging
+import multiprocessing
+import random
+import secrets
+import socket
+import sqlite3
+import sys
 import base64
-import tempfile
+import codecs
+import gzip
+import concurrent.futures
+import contextlib
+import hashlib
+import html as html_lib
+import http.cookiejar
+import importlib.util
+import io
+import ipaddress
+import json
+import math
+import mimetypes
+import threading
+import urllib.parse
+from collections import OrderedDict, deque
 
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from limits import parse as parse_rate_limit
+from limits.storage import Storage as LimitStorage
 from pydantic import BaseModel
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-import yt_dlp
-import requests as http_requests
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -22,16 +52,356 @@ logging.basicConfig(
 logger = logging.getLogger("video_downloader")
 
 # --- App Init ---
-try:
-    import curl_cffi
-    from yt_dlp.networking.impersonate import ImpersonateTarget
+# yt-dlp, curl_cffi and requests are imported on first use (or by the
+# background warm-up) so the port is bound without waiting for them.
+CURL_CFFI_AVAILABLE = importlib.util.find_spec("curl_cffi") is not None
+if CURL_CFFI_AVAILABLE:
     logger.info("✅ curl-cffi is installed and available.")
-except ImportError:
+else:
     logger.warning("⚠️ curl-cffi is NOT installed. TikTok downloads may fail (403).")
-    ImpersonateTarget = None
 
-limiter = Limiter(key_func=get_remote_address)
-app = FastAPI(title="Video Downloader API", version="2.0.0")
+# Optional faster JSON encoder and brotli compression for /extract responses
+if importlib.util.find_spec("orjson") is not None:
+    import orjson
+else:
+    orjson = None
+    logger.info("orjson is not installed; /extract responses use the stdlib JSON encoder.")
+brotli = None
+if importlib.util.find_spec("brotli") is not None:
+    import brotli
+
+yt_dlp = None
+YoutubeDLCookieJar = None
+ImpersonateTarget = None
+curl_requests = None
+http_requests = None
+HTTPAdapter = None
+_dependencies_lock = threading.Lock()
+
+
+def _load_dependencies() -> None:
+    """Import the heavy extraction dependencies once, on first use."""
+    global yt_dlp, YoutubeDLCookieJar, ImpersonateTarget, curl_requests, http_requests, HTTPAdapter
+    if yt_dlp is not None:
+        return
+    with _dependencies_lock:
+        if yt_dlp is not None:
+            return
+        import requests
+        import requests.adapters
+        import yt_dlp as _yt_dlp
+        from yt_dlp.cookies import YoutubeDLCookieJar
+        http_requests, HTTPAdapter = requests, requests.adapters.HTTPAdapter
+        if CURL_CFFI_AVAILABLE:
+            from curl_cffi import requests as curl_requests
+            from yt_dlp.networking.impersonate import ImpersonateTarget
+        yt_dlp = _yt_dlp  # Set last: other threads skip the lock once it is visible
+
+
+# =====================
+# Shared State Backend
+# =====================
+
+# memory:// (per process), sqlite:///path/state.db (workers on one host) or redis://host:6379/0
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory://")
+STATE_BACKEND_TIMEOUT = float(os.getenv("STATE_BACKEND_TIMEOUT", "0.5"))
+STATE_SQLITE_MMAP_BYTES = int(os.getenv("STATE_SQLITE_MMAP_BYTES", str(64 * 1024 * 1024)))
+
+
+class RespError(Exception):
+    """Error reply from a Redis-protocol server."""
+
+
+class SQLiteBackend:
+    """
+    Key/value store with expiry in a local SQLite file (WAL, memory-mapped),
+    shared by every worker process on the host.
+    """
+
+    PURGE_EVERY = 256  # Writes between sweeps of expired rows
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires_at REAL)"
+        )
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(f"PRAGMA mmap_size={STATE_SQLITE_MMAP_BYTES}")
+            self._local.db = db
+        return db
+
+    def _wrote(self) -> None:
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self._db().execute("DELETE FROM kv WHERE expires_at <= ?", (time.time(),))
+
+    def get(self, key: str) -> str | None:
+        row = self._db().execute(
+            "SELECT value FROM kv WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return None if row is None else str(row[0])
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        self._db().execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl),
+        )
+        self._wrote()
+
+    def delete(self, key: str) -> None:
+        self._db().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def set_default(self, key: str, value: str, ttl: float) -> str:
+        """Store `value` unless the key already holds one; return what is stored."""
+        db = self._db()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT value FROM kv WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                db.execute(
+                    "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, now + ttl),
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return value if row is None else str(row[0])
+
+    def incr(self, key: str, amount: int, ttl: float) -> int:
+        """Add to a counter, starting a new `ttl` window if it is missing or expired."""
+        db = self._db()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                value, expires_at = amount, now + ttl
+            else:
+                value, expires_at = int(row[0]) + amount, row[1]
+            db.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        self._wrote()
+        return value
+
+    def expires_at(self, key: str) -> float | None:
+        row = self._db().execute(
+            "SELECT expires_at FROM kv WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def clear_prefix(self, prefix: str) -> int:
+        cursor = self._db().execute(
+            "DELETE FROM kv WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff")
+        )
+        return cursor.rowcount
+
+    def ping(self) -> bool:
+        self._db().execute("SELECT 1")
+        return True
+
+
+class RedisBackend:
+    """
+    Key/value store with expiry on any Redis-protocol (RESP2) server, with
+    one connection per thread. Speaks only the handful of commands it needs.
+    """
+
+    def __init__(self, host: str, port: int, db: int = 0, password: str | None = None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=STATE_BACKEND_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile("rb"))
+        self._local.conn = conn
+        if self.password:
+            self._send(conn, [("AUTH", self.password)])
+        if self.db:
+            self._send(conn, [("SELECT", self.db)])
+        return conn
+
+    @staticmethod
+    def _encode(args: tuple) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by state backend")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            raise RespError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            size = int(body)
+            return None if size < 0 else reader.read(size + 2)[:-2].decode()
+        if kind == b"*":
+            size = int(body)
+            return None if size < 0 else [self._read(reader) for _ in range(size)]
+        raise RespError(f"Unexpected reply: {line[:20]!r}")
+
+    def _send(self, conn, commands: list[tuple]) -> list:
+        sock, reader = conn
+        sock.sendall(b"".join(self._encode(c) for c in commands))
+        return [self._read(reader) for _ in commands]
+
+    def _pipeline(self, *commands: tuple) -> list:
+        conn = getattr(self._local, "conn", None)
+        try:
+            return self._send(conn or self._connect(), list(commands))
+        except (OSError, ConnectionError):
+            if conn is None:
+                raise
+            # Stale pooled connection: reconnect once
+            conn[0].close()
+            self._local.conn = None
+            return self._send(self._connect(), list(commands))
+
+    def _command(self, *args):
+        return self._pipeline(args)[0]
+
+    def get(self, key: str) -> str | None:
+        return self._command("GET", key)
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        self._command("SET", key, value, "PX", max(int(ttl * 1000), 1))
+
+    def delete(self, key: str) -> None:
+        self._command("DEL", key)
+
+    def set_default(self, key: str, value: str, ttl: float) -> str:
+        """Store `value` unless the key already holds one; return what is stored."""
+        _, stored = self._pipeline(
+            ("SET", key, value, "PX", max(int(ttl * 1000), 1), "NX"), ("GET", key)
+        )
+        return stored
+
+    def incr(self, key: str, amount: int, ttl: float) -> int:
+        """Add to a counter, starting a new `ttl` window if it is missing."""
+        _, value = self._pipeline(
+            ("SET", key, 0, "PX", max(int(ttl * 1000), 1), "NX"), ("INCRBY", key, amount)
+        )
+        return value
+
+    def expires_at(self, key: str) -> float | None:
+        remaining = self._command("PTTL", key)
+        return None if remaining < 0 else time.time() + remaining / 1000
+
+    def clear_prefix(self, prefix: str) -> int:
+        cursor, cleared = "0", 0
+        while True:
+            cursor, keys = self._command("SCAN", cursor, "MATCH", prefix + "*", "COUNT", 500)
+            if keys:
+                cleared += self._command("DEL", *keys)
+            if cursor == "0":
+                return cleared
+
+    def ping(self) -> bool:
+        return self._command("PING") == "PONG"
+
+
+def _state_backend_from_url(url: str) -> SQLiteBackend | RedisBackend | None:
+    """Backend for STATE_BACKEND; None means plain per-process memory."""
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme in ("", "memory"):
+        return None
+    if parsed.scheme == "sqlite":
+        path = (parsed.netloc + parsed.path) or "state.db"
+        return SQLiteBackend(path[1:] if path.startswith("//") else path)
+    if parsed.scheme == "redis":
+        db = int(parsed.path.strip("/") or 0)
+        return RedisBackend(parsed.hostname or "localhost", parsed.port or 6379, db, parsed.password)
+    raise ValueError(f"Unsupported STATE_BACKEND: {url}")
+
+
+state_backend = _state_backend_from_url(STATE_BACKEND)
+_STATE_ERRORS = (OSError, ConnectionError, RespError, sqlite3.Error)
+
+
+class SharedLimitStorage(LimitStorage):
+    """`limits` storage (fixed window) on the shared state backend."""
+
+    STORAGE_SCHEME = ["video-downloader-state"]
+    PREFIX = "limit:"
+
+    @property
+    def base_exceptions(self):
+        return _STATE_ERRORS
+
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        return state_backend.incr(self.PREFIX + key, amount, expiry)
+
+    def get(self, key: str) -> int:
+        return int(state_backend.get(self.PREFIX + key) or 0)
+
+    def get_expiry(self, key: str) -> float:
+        return state_backend.expires_at(self.PREFIX + key) or time.time()
+
+    def check(self) -> bool:
+        try:
+            return state_backend.ping()
+        except _STATE_ERRORS:
+            return False
+
+    def reset(self) -> int | None:
+        return state_backend.clear_prefix(self.PREFIX)
+
+    def clear(self, key: str) -> None:
+        state_backend.delete(self.PREFIX + key)
+
+
+def _limiter_storage() -> dict:
+    if state_backend is None:
+        return {}
+    logger.info("Using shared state backend: %s", urllib.parse.urlsplit(STATE_BACKEND).scheme)
+    # Fall back to per-process limits rather than failing requests if the backend is down
+    return {"storage_uri": "video-downloader-state://", "in_memory_fallback_enabled": True}
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup["serving_seconds"] = time.perf_counter() - _IMPORT_STARTED
+    if YDL_POOL_WARM:
+        threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+    else:
+        _mark_ready()
+    yield
+    extraction_pool.shutdown()
+    link_index.close()
+    _stream_executor.shutdown(wait=False, cancel_futures=True)
+
+
+limiter = Limiter(key_func=get_remote_address, **_limiter_storage())
+app = FastAPI(title="Video Downloader API", version="2.0.0", lifespan=lifespan)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
@@ -44,9 +414,31 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class FormatConstraints(BaseModel):
+    max_height: int | None = None
+    max_filesize: int | None = None  # Bytes, video plus audio
+    max_bitrate: float | None = None  # Total bitrate in kbit/s
+    codecs: list[str] | None = None  # Preferred video codecs, best first (e.g. ["h264", "vp9"])
+    containers: list[str] | None = None  # Preferred extensions, best first (e.g. ["mp4"])
+    progressive_only: bool = False  # Only formats that already carry audio
+
+
 class VideoRequest(BaseModel):
     url: str
     cookies: str | None = None  # Optional base64-encoded Netscape cookies
+    deadline_ms: int | None = None  # Optional time budget, capped by EXTRACT_DEADLINE_SECONDS
+    merge: bool = False  # Mux split video+audio server-side and return merged_url
+    constraints: FormatConstraints | None = None  # Pick the format from these instead of the best
+    # Playlist paging: setting limit or cursor returns one page of entries
+    offset: int = 0
+    limit: int | None = None
+    cursor: str | None = None  # next_cursor from the previous page
+
+
+class BatchRequest(BaseModel):
+    requests: list[VideoRequest]
+    parallelism: int | None = None  # Optional, capped by EXTRACT_BATCH_PARALLELISM
+    deadline_ms: int | None = None  # Optional per-item time budget
 
 
 # =====================
@@ -60,467 +452,3857 @@ def root():
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "state_backend": urllib.parse.urlsplit(STATE_BACKEND).scheme or "memory",
+        "cache": extraction_cache.stats(),
+        "singleflight": extraction_flight.stats(),
+        "extraction_pool": extraction_pool.stats(),
+        "ydl_pool": ydl_pool.stats(),
+        "breakers": strategy_breakers.snapshot(),
+        "fast_paths": fast_paths.enabled(),
+        "link_index": link_index.stats(),
+        "streams": stream_slots.stats(),
+        "artifacts": artifact_cache.stats(),
+        "jobs": job_store.stats(),
+    }
 
 
-# =====================
-# Link Extraction (Core)
-# =====================
+# --- Startup & readiness ---
+# Seconds since the module started importing, for tracking cold starts across releases
+startup = {
+    "import_seconds": None,  # Module import finished
+    "serving_seconds": None,  # Lifespan started; the port is bound right after
+    "ready_seconds": None,  # Background warm-up finished
+    "warmup_steps_ms": {},
+}
+
+
+def _mark_ready() -> None:
+    startup["ready_seconds"] = time.perf_counter() - _IMPORT_STARTED
+    logger.info(
+        "Startup v%s: import %.0f ms, serving %.0f ms, ready %.0f ms",
+        app.version, startup["import_seconds"] * 1000,
+        startup["serving_seconds"] * 1000, startup["ready_seconds"] * 1000,
+    )
+
 
-def _get_cookie_file(request_cookies_b64: str | None) -> str | None:
+def _warm_up() -> None:
     """
-    Resolve cookie file path. Priority:
-      1. Per-request base64 cookies from client
-      2. INSTAGRAM_COOKIES env var (base64)
-      3. None (no cookies)
+    Pay the cold-start costs off the request path: heavy imports, yt-dlp's
+    extractor registry, pooled YoutubeDL instances (curl_cffi impersonation
+    included), the shared HTTP client and the link index.
     """
-    raw = request_cookies_b64 or os.getenv("INSTAGRAM_COOKIES")
-    if not raw:
-        return None
+    def step(name: str, fn) -> None:
+        started = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            logger.warning("Warm-up step %s failed: %s", name, e)
+        startup["warmup_steps_ms"][name] = round((time.perf_counter() - started) * 1000, 1)
 
-    try:
-        decoded = base64.b64decode(raw).decode("utf-8")
-        tmp = tempfile.NamedTemporaryFile(
-            mode="w", suffix=".txt", delete=False, prefix="cookies_"
-        )
-        tmp.write(decoded)
-        tmp.close()
-        return tmp.name
-    except Exception as e:
-        logger.warning("Failed to decode cookies: %s", e)
-        return None
+    step("imports", _load_dependencies)
+    step("extractors", lambda: yt_dlp.extractor.gen_extractor_classes())
+    if EXTRACT_EXECUTOR == "thread":
+        step("ydl_pool", ydl_pool.warm)
+    else:
+        step("workers", extraction_pool.warm)
+    step("http_client", _http_session)
+    step("link_index", link_index.open)
+    _mark_ready()
 
 
-def _parse_cookies_from_file(cookie_file: str | None) -> dict:
-    """Parse Netscape cookie file into a dict for requests."""
-    cookies = {}
-    if not cookie_file:
-        return cookies
-    try:
-        with open(cookie_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('#') or not line:
-                    continue
-                parts = line.split('\t')
-                if len(parts) >= 7:
-                    cookies[parts[5]] = parts[6]
-    except Exception:
-        pass
-    return cookies
+@app.get("/ready")
+def readiness():
+    """Readiness probe: 503 until the background warm-up has finished."""
+    ready = startup["ready_seconds"] is not None
+    body = {"status": "ready" if ready else "warming", "version": app.version, **startup}
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+
+# =====================
+# Metrics
+# =====================
+
+METRICS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+_trace = threading.local()
+
+
+class _Stage:
+    """Outcome holder yielded by `_stage`; set `ok` or `outcome` inside the block."""
+
+    __slots__ = ("name", "outcome", "seconds")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.outcome = "success"
+        self.seconds = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.outcome == "success"
 
+    @ok.setter
+    def ok(self, value: bool) -> None:
+        self.outcome = "success" if value else "failure"
 
-def _extract_instagram_image(url: str, cookie_file: str | None) -> dict | None:
+
+@contextlib.contextmanager
+def _stage(name: str, records: list | None = None):
     """
-    Fallback: Extract image URL directly from Instagram API when yt-dlp fails.
-    Uses Instagram's private API with user cookies.
+    Time an extraction stage and append (name, seconds, outcome) to the
+    current request's trace. Pass `records` explicitly from helper threads.
     """
-    # Extract shortcode from URL
-    match = re.search(r'/p/([^/?]+)', url) or re.search(r'/reel/([^/?]+)', url)
-    if not match:
-        return None
+    if records is None:
+        records = getattr(_trace, "records", None)
+    stage = _Stage(name)
+    started = time.perf_counter()
+    try:
+        yield stage
+    except BaseException:
+        stage.outcome = "failure"
+        raise
+    finally:
+        stage.seconds = time.perf_counter() - started
+        if records is not None:
+            records.append((name, stage.seconds, stage.outcome))
+
+
+def _skip_stage(name: str, outcome: str = "skipped") -> None:
+    """Note a stage that was not attempted on the current request's trace."""
+    records = getattr(_trace, "records", None)
+    if records is not None:
+        records.append((name, 0.0, outcome))
 
-    shortcode = match.group(1)
-    cookies = _parse_cookies_from_file(cookie_file)
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
-        'X-IG-App-ID': '936619743392459',
-        'X-Requested-With': 'XMLHttpRequest',
+def _platform(url: str) -> str:
+    """Coarse platform label for metrics."""
+    host = (urllib.parse.urlsplit(url).hostname or "").lower()
+    if host.endswith(("youtube.com", "youtu.be")):
+        return "youtube"
+    if host.endswith("tiktok.com"):
+        return "tiktok"
+    if host.endswith("instagram.com"):
+        return "instagram"
+    return "other"
+
+
+class Metrics:
+    """Minimal thread-safe registry of labelled counters and histograms."""
+
+    def __init__(self, buckets: tuple = METRICS_BUCKETS):
+        self.buckets = buckets
+        self._counters: dict[tuple, float] = {}
+        self._histograms: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1.0, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                # Cumulative bucket counts, then sum and count
+                hist = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> list[str]:
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{self._labels(labels)} {value:g}")
+            for (name, labels), hist in sorted(self._histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                for bound, count in zip(self.buckets, hist):
+                    le = 'le="%g"' % bound
+                    lines.append(f"{name}_bucket{self._labels(labels, le)} {count}")
+                le = 'le="+Inf"'
+                lines.append(f"{name}_bucket{self._labels(labels, le)} {hist[-1]}")
+                lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]:.6f}")
+                lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+        return lines
+
+
+metrics = Metrics()
+
+
+def _record_trace(platform: str, records: list) -> None:
+    for stage, seconds, outcome in records:
+        metrics.observe("video_downloader_stage_seconds", seconds, platform=platform, stage=stage)
+        metrics.inc("video_downloader_stage_total", platform=platform, stage=stage, outcome=outcome)
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus text exposition of extraction metrics and component stats."""
+    lines = metrics.render()
+    sections = {
+        "cache": extraction_cache.stats(),
+        "singleflight": extraction_flight.stats(),
+        "pool": extraction_pool.stats(),
+        "stream": stream_slots.stats(),
+        "artifacts": artifact_cache.stats(),
+        "jobs": job_store.stats(),
+        "link_index": link_index.stats(),
     }
+    for section, stats in sections.items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = f"video_downloader_{section}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value:g}")
+    lines.append("# TYPE video_downloader_startup_seconds gauge")
+    for phase in ("import", "serving", "ready"):
+        if startup[f"{phase}_seconds"] is not None:
+            lines.append(f'video_downloader_startup_seconds{{phase="{phase}"}} {startup[f"{phase}_seconds"]:.6f}')
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+# =====================
+# Deadlines
+# =====================
+
+EXTRACT_DEADLINE_SECONDS = float(os.getenv("EXTRACT_DEADLINE_SECONDS", "45"))
+# Don't start a stage with less than this much budget left
+STAGE_MIN_SECONDS = {
+    "extract_info": 3.0,
+    "extract_listing": 3.0,
+    "extract_flat": 2.0,
+    "ig_race": 1.0,
+    "ig_oembed": 1.0,
+    "instagram_post": 1.0,
+    "tiktok_web": 1.0,
+}
+# Fraction of the remaining budget a stage may spend, so later fallbacks still get a turn
+STAGE_BUDGET_SHARE = {
+    "extract_info": 0.6,
+    "extract_listing": 0.6,
+    "extract_flat": 0.5,
+    "ig_race": 0.7,
+    "ig_oembed": 1.0,
+    # Fast paths make one request; leave the rest for yt-dlp if they miss
+    "instagram_post": 0.3,
+    "tiktok_web": 0.3,
+}
+
+
+class Deadline:
+    """Absolute wall-clock deadline for one request (picklable for process pools)."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.time() + seconds
+
+    @classmethod
+    def for_request(cls, deadline_ms: int | None) -> "Deadline":
+        seconds = EXTRACT_DEADLINE_SECONDS
+        if deadline_ms:
+            seconds = min(seconds, max(deadline_ms, 0) / 1000)
+        return cls(seconds)
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.time(), 0.0)
+
+    def allows(self, stage: str) -> bool:
+        """Whether `stage` can still start; records it as skipped otherwise."""
+        if self.remaining() >= STAGE_MIN_SECONDS.get(stage, 0.0):
+            return True
+        _skip_stage(stage)
+        logger.warning("Skipping %s: %.1fs of budget left", stage, self.remaining())
+        return False
 
-    # Try Instagram's GraphQL API with cookies (works for private posts too)
-    # Try Instagram's GraphQL API with cookies (works for private posts too)
-    api_urls = [
-        f'https://www.instagram.com/p/{shortcode}/?__a=1&__d=dis',
-        f'https://www.instagram.com/p/{shortcode}/?__a=1',
-        f'https://www.instagram.com/p/{shortcode}/', # Main page fallback
+    def budget(self, stage: str, cap: float | None = None) -> float:
+        """Timeout to hand to `stage`: its share of what's left, optionally capped."""
+        seconds = self.remaining() * STAGE_BUDGET_SHARE.get(stage, 1.0)
+        seconds = max(seconds, STAGE_MIN_SECONDS.get(stage, 0.0))
+        return min(seconds, cap) if cap is not None else seconds
+
+
+def _stage_report(records: list) -> list[dict]:
+    """Compact per-stage timing for API responses."""
+    return [
+        {"name": name, "ms": round(seconds * 1000, 1), "outcome": outcome}
+        for name, seconds, outcome in records
     ]
 
-    for api_url in api_urls:
-        try:
-            logger.info("Instagram Image Fallback: Trying %s", api_url)
-            resp = http_requests.get(api_url, headers=headers, cookies=cookies, timeout=15)
-            logger.info("Instagram Image Fallback: Status %s", resp.status_code)
 
-            if resp.status_code == 200:
-                # 1. Try JSON parsing
-                try:
-                    data = resp.json()
-                    # ... [JSON Logic from before] ...
-                    if 'graphql' in data:
-                        items = [data['graphql'].get('shortcode_media', {})]
-                    else:
-                        items = data.get('items', [])
-                    
-                    if items:
-                        item = items[0]
-                        media_urls = []
-                        
-                        carousel = item.get('carousel_media', [])
-                        if not carousel and 'edge_sidecar_to_children' in item:
-                            edges = item['edge_sidecar_to_children'].get('edges', [])
-                            carousel = [edge['node'] for edge in edges]
-                        
-                        if carousel:
-                            for media in carousel:
-                                candidates = media.get('image_versions2', {}).get('candidates', [])
-                                if candidates:
-                                    candidates.sort(key=lambda x: x.get('width', 0), reverse=True)
-                                    media_urls.append(candidates[0].get('url'))
-                                else:
-                                    url = media.get('display_url')
-                                    if url:
-                                        media_urls.append(url)
-                        else:
-                            candidates = item.get('image_versions2', {}).get('candidates', [])
-                            if candidates:
-                                candidates.sort(key=lambda x: x.get('width', 0), reverse=True)
-                                media_urls.append(candidates[0].get('url'))
-                            else:
-                                url = item.get('display_url')
-                                if url:
-                                    media_urls.append(url)
-
-                        if media_urls:
-                            caption = 'Instagram Image'
-                            if 'caption' in item:
-                                caption = item.get('caption', {}).get('text', 'Instagram Image')
-                            elif 'edge_media_to_caption' in item:
-                                edges = item['edge_media_to_caption'].get('edges', [])
-                                if edges:
-                                    caption = edges[0].get('node', {}).get('text', 'Instagram Image')
-
-                            title = "".join(c for c in caption if c.isalnum() or c in " _-").strip()[:100]
-                            logger.info("Instagram Image Fallback: Found %d images directly!", len(media_urls))
-                            return {
-                                'direct_url': media_urls[0],
-                                'media_urls': media_urls,
-                                'title': title,
-                                'ext': 'jpg',
-                                'is_video': False,
-                            }
-                except Exception:
-                    # 2. HTML Fallback: Regex Scraping
-                    if 'text/html' in resp.headers.get('Content-Type', ''):
-                        # 1. Regex to find all potential image URLs in JSON blobs
-                        # Matches: "display_url":"https://..." or "src":"https://..."
-                        # We also handle unicode escaped slashes
-                        matches = re.findall(r'"(?:display_url|src)"\s*:\s*"([^"]+)"', html)
-                        
-                        raw_urls = []
-                        for m in matches:
-                            try:
-                                u = m.encode('utf-8').decode('unicode_escape').replace('\\/', '/')
-                                if u.startswith('http') and u not in raw_urls:
-                                    raw_urls.append(u)
-                            except Exception:
-                                pass
-                        
-                        # Filter URLs to find carousel images (usually have similar dimensions or CDN path)
-                        # High-res Instagram images often have 1080x1080 or are from scontent*
-                        unique_urls = [u for u in raw_urls if 'scontent' in u and '/v/' in u and '.jpg' in u]
-                        
-                        # If filtering too strictly, just take all unique_urls
-                        if not unique_urls:
-                            unique_urls = [u for u in raw_urls if 'scontent' in u]
-
-                        # 2. Meta tag fallback (og:image)
-                        if not unique_urls:
-                            meta_match = re.search(r'<meta property="og:image" content="([^"]+)"', html)
-                            if meta_match:
-                                u = meta_match.group(1).replace('&amp;', '&')
-                                unique_urls.append(u)
-                        
-                        if unique_urls:
-                             logger.info("Instagram Image Fallback: Found %d images via HTML scraping!", len(unique_urls))
-                             # Try to find title
-                             title_match = re.search(r'<meta property="og:title" content="([^"]+)"', html)
-                             title = title_match.group(1).split('•')[0].strip() if title_match else "Instagram Image"
-                             title = "".join(c for c in title if c.isalnum() or c in " _-").strip()[:100]
-
-                             return {
-                                'direct_url': unique_urls[0],
-                                'media_urls': unique_urls,
-                                'title': title,
-                                'ext': 'jpg',
-                                'is_video': False,
-                            }
-                except Exception as e:
-                    logger.warning("HTML fallback failed: %s", e)
+# =====================
+# Strategy Health & Circuit Breakers
+# =====================
+
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+# Outcomes older than this are forgotten, so demoted strategies drift back to default order
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "300"))
+BREAKER_MIN_SAMPLES = int(os.getenv("BREAKER_MIN_SAMPLES", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.8"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "60"))
+LATENCY_EWMA_ALPHA = 0.3
+
+
+class StrategyHealth:
+    """Sliding-window success rate, latency EWMA and breaker state for one strategy."""
+
+    def __init__(self):
+        self.outcomes: deque[tuple[float, bool]] = deque(maxlen=BREAKER_WINDOW)
+        self.latency: float | None = None
+        self.state = "closed"  # closed | open | half_open
+        self.opened_at = 0.0
+        self.probing = False
+
+    def _prune(self) -> None:
+        cutoff = time.monotonic() - BREAKER_WINDOW_SECONDS
+        while self.outcomes and self.outcomes[0][0] < cutoff:
+            self.outcomes.popleft()
+
+    @property
+    def success_rate(self) -> float:
+        self._prune()
+        # Too few recent samples: keep the default position
+        if len(self.outcomes) < BREAKER_MIN_SAMPLES:
+            return 1.0
+        return sum(ok for _, ok in self.outcomes) / len(self.outcomes)
+
+    @property
+    def is_open(self) -> bool:
+        """Open and still cooling down (no side effects, unlike `allow`)."""
+        return self.state == "open" and time.monotonic() - self.opened_at < BREAKER_COOLDOWN
+
+    def allow(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+            self.state = "half_open"
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self.probing:
+            self.probing = True  # Let exactly one probe through
+            return True
+        return False
+
+    def record(self, outcome: str, seconds: float) -> None:
+        if outcome not in ("success", "failure"):
+            self.probing = False  # Cancelled/skipped/rejected probes don't count either way
+            return
+        ok = outcome == "success"
+        self.outcomes.append((time.monotonic(), ok))
+        self.latency = seconds if self.latency is None else (
+            LATENCY_EWMA_ALPHA * seconds + (1 - LATENCY_EWMA_ALPHA) * self.latency
+        )
+        if self.state == "half_open":
+            self.probing = False
+            if ok:
+                self.state = "closed"
+                self.outcomes.clear()
             else:
-                 logger.warning("Response status: %s", resp.status_code)
+                self.state, self.opened_at = "open", time.monotonic()
+        elif self.state == "closed" and 1 - self.success_rate >= BREAKER_FAILURE_RATE:
+            self.state, self.opened_at = "open", time.monotonic()
 
-        except Exception as e:
-            logger.warning("Instagram Fallback API failed for %s: %s", api_url, e)
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "success_rate": round(self.success_rate, 3),
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "samples": len(self.outcomes),
+        }
 
-    # Fallback: Try OEmbed API (public posts only, no auth needed)
-    try:
-        oembed_url = f'https://www.instagram.com/api/v1/oembed/?url=https://www.instagram.com/p/{shortcode}/'
-        logger.info("Instagram Image Fallback: Trying OEmbed %s", oembed_url)
-        resp = http_requests.get(oembed_url, headers=headers, timeout=10)
-        if resp.status_code == 200:
-            data = resp.json()
-            thumbnail = data.get('thumbnail_url')
-            if thumbnail:
-                title = data.get('title', 'Instagram Image')
-                title = "".join(c for c in title if c.isalnum() or c in " _-").strip()[:100]
-                logger.info("Instagram Image Fallback: Found thumbnail via OEmbed!")
-                return {
-                    'direct_url': thumbnail,
-                    'title': title,
-                    'ext': 'jpg',
-                    'is_video': False,
-                }
-    except Exception as e:
-        logger.warning("Instagram OEmbed API failed: %s", e)
 
-    return None
+class StrategyBreakers:
+    """Per-(platform, strategy) health, used to skip and reorder fallbacks."""
 
-@app.post("/extract")
-@limiter.limit("10/minute")
-def extract_info(video_request: VideoRequest, request: Request):
-    """
-    Extract direct media URL and metadata.
-    Returns JSON with direct_url for client-side downloading.
-    """
-    url = video_request.url.strip()
-    if not url.startswith("http"):
-        raise HTTPException(status_code=400, detail="Invalid URL. Must start with http(s).")
+    def __init__(self, groups: dict[str, tuple]):
+        self.groups = groups
+        self._health: dict[tuple[str, str], StrategyHealth] = {}
+        self._lock = threading.Lock()
 
-    logger.info("Cookies received: %s", "YES" if video_request.cookies else "NO")
-    cookie_file = _get_cookie_file(video_request.cookies)
-    logger.info("Cookie file path: %s", cookie_file)
+    def _get(self, platform: str, strategy: str) -> StrategyHealth:
+        key = (platform, strategy)
+        health = self._health.get(key)
+        if health is None:
+            health = self._health[key] = StrategyHealth()
+        return health
 
-    ydl_opts = {
-        "quiet": False,  # Enable output for debugging
-        "verbose": True, # Enable verbose output
-        "ignoreerrors": True,
-        "noplaylist": "instagram.com" not in url and "tiktok.com" not in url, 
-        "extract_flat": False,
-        "skip_download": True,
-        "nocheckcertificate": True, # Disable SSL checks to avoid handshake timeouts
-        # Allow selecting 'none' video formats (images)
-        "writethumbnail": True,
-        "ignore_no_formats_error": True, # Key fix for Instagram images
+    def allow(self, platform: str, strategy: str) -> bool:
+        with self._lock:
+            return self._get(platform, strategy).allow()
 
-        "user_agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-            "AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/120.0.0.0 Safari/537.36"
-        ),
-        "extractor_args": {
-            "youtube": {
-                "player_client": ["android", "web"],
-                "player_skip": ["web_safari", "web_creator"],
-            }
-        },
-        "http_headers": {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
-            "Accept-Language": "en-US,en;q=0.9",
-            "Sec-Fetch-Mode": "navigate",
-            "Sec-Fetch-Site": "none",
-            "Sec-Fetch-Dest": "document",
-            "Upgrade-Insecure-Requests": "1",
-        },
-    }
+    def record(self, platform: str, strategy: str, outcome: str, seconds: float) -> None:
+        with self._lock:
+            self._get(platform, strategy).record(outcome, seconds)
 
-    # Only use impersonation (curl_cffi) for TikTok
-    if "tiktok.com" in url.lower() and ImpersonateTarget:
-        ydl_opts["impersonate"] = ImpersonateTarget(client="chrome")
+    def order(self, platform: str, tiers: tuple) -> list[str]:
+        """
+        Strategies tier by tier, never crossing tiers; within one, best recent
+        success rate first, then lowest latency. Ties keep the listed order.
+        """
+        with self._lock:
+            def rank(name: str) -> tuple[float, float]:
+                members = [self._get(platform, m) for m in self.groups.get(name, (name,))]
+                latencies = [h.latency for h in members if h.latency is not None]
+                return -max(h.success_rate for h in members), min(latencies, default=0.0)
+            return [name for tier in tiers for name in sorted(tier, key=rank)]
 
-    if cookie_file:
-        ydl_opts["cookiefile"] = cookie_file
+    def all_open(self, platform: str, strategy: str) -> bool:
+        """Whether the strategy (every member, for a group) is breaker-open."""
+        with self._lock:
+            members = self.groups.get(strategy, (strategy,))
+            return all(self._get(platform, m).is_open for m in members)
 
-    try:
-        logger.info("Analyzing URL: %s", url)
+    def snapshot(self) -> dict:
+        with self._lock:
+            result: dict[str, dict] = {}
+            for (platform, strategy), health in sorted(self._health.items()):
+                result.setdefault(platform, {})[strategy] = health.snapshot()
+            return result
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            try:
-                info = ydl.extract_info(url, download=False)
-            except yt_dlp.utils.DownloadError:
-                info = None
 
-            logger.info("Extraction Result: %s", "None" if info is None else f"Found info with keys: {list(info.keys()) if info else 'None'}")
+# Fallback tiers per platform, highest fidelity first (thumbnail-only oEmbed
+# last). Strategies are reordered by recent health only within a tier.
+# Groups are raced together
+PLATFORM_STRATEGIES = {
+    "instagram": (("extract_info",), ("extract_flat", "ig_race"), ("ig_oembed",)),
+}
+DEFAULT_STRATEGIES = (("extract_info",), ("extract_flat",))
+# Posts the link index has seen as images: yt-dlp's Instagram extractor only
+# handles video, so go to the API race first
+IMAGE_POST_STRATEGIES = {
+    "instagram": (("ig_race",), ("extract_info", "extract_flat"), ("ig_oembed",)),
+}
+STRATEGY_GROUPS = {"ig_race": ("ig_api_dis", "ig_api", "ig_page")}
 
-            if info is None:
-                logger.warning("Extraction failed, retrying with distinct fallback options for Image...")
-                # Create fresh options for fallback
-                fallback_opts = ydl_opts.copy()
-                fallback_opts.pop('format', None) # Remove format constraint
-                fallback_opts['extract_flat'] = True # Get metadata only
-                
-                with yt_dlp.YoutubeDL(fallback_opts) as ydl_fallback:
-                    try:
-                        info = ydl_fallback.extract_info(url, download=False)
-                    except Exception as e:
-                        logger.error("Fallback extraction also failed: %s", e)
-                        raise HTTPException(status_code=400, detail="Could not extract media (Video or Image).")
+strategy_breakers = StrategyBreakers(STRATEGY_GROUPS)
 
 
-            if info is None:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Could not extract info. The URL may be invalid or require login.",
-                )
+class UpstreamError(Exception):
+    """The platform answered with a blocking, throttling or server-error status."""
 
-            media_urls = []
-            # Handle carousels / playlists
-            if "entries" in info:
-                logger.info("Detected carousel/playlist with %d entries.", len(info["entries"]))
-                entries = list(info["entries"])
-                if not entries:
-                    raise HTTPException(status_code=400, detail="Empty playlist/carousel.")
-                
-                # Process all entries to get URLs
-                for entry in entries:
-                    # Try to get URL from entry directly or its formats
-                    e_url = entry.get("url")
-                    if not e_url:
-                        # Try formats
-                        formats = entry.get("formats", [])
-                        if formats:
-                            e_url = formats[-1].get("url")
-                    
-                    if not e_url:
-                        # Try thumbnail (singular) or thumbnails (list)
-                        e_url = entry.get("thumbnail")
-                        if not e_url:
-                            thumbnails = entry.get("thumbnails", [])
-                            if thumbnails:
-                                e_url = thumbnails[-1].get("url")
-                    
-                    if e_url:
-                        media_urls.append(e_url)
-                    else:
-                        logger.warning("Could not find URL for entry in carousel")
-                
-                # Set info to first entry for metadata extraction
-                info = entries[0]
-
-            # Determine media type
-            is_video = True
-            if info.get("vcodec") == "none" or info.get("ext") in [
-                "jpg", "jpeg", "png", "webp", "heic",
-            ]:
-                is_video = False
-
-            # Debug: Log all possible URL sources
-            logger.info("DEBUG url=%s", info.get("url"))
-            logger.info("DEBUG thumbnail=%s", info.get("thumbnail"))
-            logger.info("DEBUG thumbnails=%s", info.get("thumbnails"))
-            logger.info("DEBUG formats count=%s", len(info.get("formats", [])))
-            formats = info.get("formats", [])
-            for i, f in enumerate(formats):
-                logger.info("DEBUG format[%d]: url=%s vcodec=%s ext=%s", i, f.get("url", "")[:80] if f.get("url") else "None", f.get("vcodec"), f.get("ext"))
-
-            # Get the best direct URL
-            direct_url = info.get("url")
-            http_headers = info.get("http_headers", {})
-
-            # If no URL selected by yt-dlp, find it manually from formats
-            if not direct_url:
-                 if formats:
-                     direct_url = formats[-1].get("url")
-                     if formats[-1].get("http_headers"):
-                         http_headers = formats[-1].get("http_headers")
-
-            # Fallback: thumbnails list
-            if not direct_url:
-                thumbnails = info.get("thumbnails", [])
-                if thumbnails:
-                    direct_url = thumbnails[-1].get("url")
-                    is_video = False
-
-            # Fallback: thumbnail (singular key)
-            if not direct_url:
-                thumbnail = info.get("thumbnail")
-                if thumbnail:
-                    direct_url = thumbnail
-                    is_video = False
-
-            # Instagram image fallback: use direct API when yt-dlp fails
-            if not direct_url and "instagram.com" in url:
-                logger.info("Trying Instagram Image API fallback...")
-                ig_result = _extract_instagram_image(url, cookie_file)
-                if ig_result:
-                    return {
-                        "status": "success",
-                        "title": ig_result['title'] or "Media",
-                        "direct_url": ig_result['direct_url'],
-                        "media_urls": ig_result.get('media_urls', [ig_result['direct_url']]),
-                        "ext": ig_result['ext'],
-                        "media_type": "image",
-                        "headers": http_headers,
-                    }
 
-            if not direct_url:
-                logger.error("No direct URL found. Full info dump: %s", {k: v for k, v in info.items() if k not in ('formats', 'http_headers', 'requested_subtitles')})
-                raise HTTPException(
-                    status_code=400,
-                    detail="Could not find a direct media URL for this content.",
-                )
+_UPSTREAM_FAULT_MESSAGE = re.compile(
+    r"HTTP Error (?:403|429|5\d\d)\b|timed out|Connection (?:refused|reset|aborted)", re.I
+)
 
-            ext = info.get("ext", "mp4" if is_video else "jpg")
-            if ext == "none":
-                ext = "jpg"
-            
-            # Force mp4 ext if the url is mp4 but metadata says otherwise
-            if is_video and ".mp4" in direct_url:
-                 ext = "mp4"
-
-            media_type = "video" if is_video else "image"
-            title = info.get("title", "Media")
-            # Sanitize title
-            title = "".join(c for c in title if c.isalnum() or c in " _-").strip()[:100]
-
-            # Ensure headers are populated
-            if not http_headers:
-                http_headers = {}
-            
-            # Force User-Agent if missing
-            if "User-Agent" not in http_headers:
-                http_headers["User-Agent"] = ydl_opts.get("user_agent")
-            
-            # Force Referer for TikTok if missing (often required)
-            if "tiktok.com" in url.lower() and "Referer" not in http_headers:
-                http_headers["Referer"] = "https://www.tiktok.com/"
 
-            logger.info(
-                "Extracted %s: title='%s', ext='%s'", media_type, title, ext
-            )
+def _raise_for_upstream(status: int, url: str) -> None:
+    if status in (403, 429) or status >= 500:
+        raise UpstreamError(f"HTTP {status} from {_platform(url)}")
 
-            return {
-                "status": "success",
-                "title": title or "Media",
-                "direct_url": direct_url,
-                "media_urls": media_urls if 'media_urls' in locals() and media_urls else [direct_url],
-                "ext": ext,
-                "media_type": media_type,
-                "headers": http_headers  # Pass headers to client
-            }
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        import traceback
-        logger.error("Extraction failed: %s\n%s", str(e), traceback.format_exc())
-        raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        # Clean up temp cookie file
-        if cookie_file and os.path.exists(cookie_file):
-            try:
-                os.remove(cookie_file)
-            except OSError:
-                pass
+def _is_upstream_fault(error: BaseException | None) -> bool:
+    """
+    Whether a failure says the platform is unhealthy (blocked, throttled,
+    erroring or unreachable) rather than that this URL has nothing to serve.
+    Only the former counts toward circuit breakers.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, (UpstreamError, OSError)):  # Includes timeouts and connection errors
+            return True
+        if yt_dlp is not None:
+            if isinstance(error, yt_dlp.networking.exceptions.HTTPError):
+                return error.status in (403, 429) or error.status >= 500
+            if isinstance(error, yt_dlp.networking.exceptions.TransportError):
+                return True
+        if _UPSTREAM_FAULT_MESSAGE.search(str(error)):
+            return True
+        # yt-dlp wraps the underlying error as `cause` or in `exc_info`
+        cause = getattr(error, "cause", None)
+        exc_info = getattr(error, "exc_info", None)
+        if not isinstance(cause, BaseException):
+            cause = exc_info[1] if isinstance(exc_info, tuple) and len(exc_info) > 1 else None
+        error = cause or error.__cause__ or error.__context__
+    return False
 
 
 # =====================
-# Legacy File Serving (backward compat)
+# Link Extraction (Core)
 # =====================
 
+COOKIE_CACHE_MAX_ENTRIES = int(os.getenv("COOKIE_CACHE_MAX_ENTRIES", "256"))
+
+_cookie_jars: OrderedDict[str, YoutubeDLCookieJar] = OrderedDict()
+_cookie_jars_lock = threading.Lock()
+
+
+def _cookie_fingerprint(request_cookies_b64: str | None) -> str:
+    """Short stable hash of the cookies that will be used for a request."""
+    raw = request_cookies_b64 or os.getenv("INSTAGRAM_COOKIES")
+    if not raw:
+        return "-"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _get_cookie_jar(request_cookies_b64: str | None) -> YoutubeDLCookieJar | None:
+    """
+    Resolve the cookie jar for a request. Priority:
+      1. Per-request base64 cookies from client
+      2. INSTAGRAM_COOKIES env var (base64)
+      3. None (no cookies)
+    Parsed jars are cached by content hash and must be treated as read-only.
+    """
+    raw = request_cookies_b64 or os.getenv("INSTAGRAM_COOKIES")
+    if not raw:
+        return None
+
+    key = _cookie_fingerprint(raw)
+    with _cookie_jars_lock:
+        jar = _cookie_jars.get(key)
+        if jar is not None:
+            _cookie_jars.move_to_end(key)
+            return jar
+
+    _load_dependencies()
+    try:
+        decoded = base64.b64decode(raw).decode("utf-8")
+        jar = YoutubeDLCookieJar()
+        jar.load(io.StringIO(decoded))
+    except Exception as e:
+        logger.warning("Failed to decode cookies: %s", e)
+        return None
+
+    with _cookie_jars_lock:
+        _cookie_jars[key] = jar
+        while len(_cookie_jars) > COOKIE_CACHE_MAX_ENTRIES:
+            _cookie_jars.popitem(last=False)
+    return jar
+
+
+# --- Shared HTTP client ---
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+INSTAGRAM_RACE_TIMEOUT = float(os.getenv("INSTAGRAM_RACE_TIMEOUT", "15"))
+INSTAGRAM_HTML_MAX_BYTES = int(os.getenv("INSTAGRAM_HTML_MAX_BYTES", str(8 * 1024 * 1024)))
+# Overridable so the fallback can be pointed at a local stand-in (see bench/)
+INSTAGRAM_BASE_URL = os.getenv("INSTAGRAM_BASE_URL", "https://www.instagram.com").rstrip("/")
+
+# 0 sizes the race pool so every extraction worker can run all its candidates at once
+INSTAGRAM_RACE_WORKERS = int(os.getenv("INSTAGRAM_RACE_WORKERS", "0"))
+
+_http_client = None
+_http_client_lock = threading.Lock()
+_race_pool = None
+
+
+def _race_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Threads for the Instagram candidate race, created on first use."""
+    global _race_pool
+    if _race_pool is None:
+        with _http_client_lock:
+            if _race_pool is None:
+                workers = INSTAGRAM_RACE_WORKERS or EXTRACT_WORKERS * len(STRATEGY_GROUPS["ig_race"])
+                _race_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max(workers, 1), thread_name_prefix="ig-race"
+                )
+    return _race_pool
+
+
+class _RejectCookies(http.cookiejar.DefaultCookiePolicy):
+    """Cookie policy that never stores response cookies on the shared session."""
+
+    def set_ok(self, cookie, request) -> bool:
+        return False
+
+
+def _http_session():
+    """
+    Shared keep-alive HTTP client. Uses curl_cffi (HTTP/2, Chrome TLS
+    fingerprint) when installed, otherwise a pooled requests.Session.
+    It serves every client, so it keeps connections but never cookies:
+    pass them per request.
+    """
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _load_dependencies()
+                if curl_requests is not None:
+                    _http_client = curl_requests.Session(impersonate="chrome", discard_cookies=True)
+                else:
+                    session = http_requests.Session()
+                    session.cookies.set_policy(_RejectCookies())
+                    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_POOL_SIZE)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    _http_client = session
+    return _http_client
+
+
+def _sanitize_title(title: str) -> str:
+    return "".join(c for c in title if c.isalnum() or c in " _-").strip()[:100]
+
+
+def _best_candidate_url(media: dict) -> str | None:
+    # Reels and carousel videos: the video itself rather than its cover image
+    videos = media.get('video_versions') or []
+    if videos:
+        return max(videos, key=lambda x: x.get('width', 0)).get('url')
+    if media.get('video_url'):
+        return media['video_url']
+    candidates = media.get('image_versions2', {}).get('candidates', [])
+    if candidates:
+        return max(candidates, key=lambda x: x.get('width', 0)).get('url')
+    return media.get('display_url')
+
+
+def _parse_instagram_json(data: dict) -> dict | None:
+    """Pull image URLs and caption out of an Instagram API/GraphQL payload."""
+    if 'graphql' in data:
+        items = [data['graphql'].get('shortcode_media', {})]
+    else:
+        items = data.get('items', [])
+    if not items:
+        return None
+
+    item = items[0]
+    carousel = item.get('carousel_media', [])
+    if not carousel and 'edge_sidecar_to_children' in item:
+        edges = item['edge_sidecar_to_children'].get('edges', [])
+        carousel = [edge['node'] for edge in edges]
+
+    media = carousel or [item]
+    media_urls = [u for u in (_best_candidate_url(m) for m in media) if u]
+    if not media_urls:
+        return None
+    is_video = bool(media[0].get('video_versions') or media[0].get('video_url'))
+
+    caption = 'Instagram Image'
+    if item.get('caption'):
+        caption = item['caption'].get('text', 'Instagram Image')
+    elif 'edge_media_to_caption' in item:
+        edges = item['edge_media_to_caption'].get('edges', [])
+        if edges:
+            caption = edges[0].get('node', {}).get('text', 'Instagram Image')
+
+    logger.info("Instagram Image Fallback: Found %d images directly!", len(media_urls))
+    return {
+        'direct_url': media_urls[0],
+        'media_urls': media_urls,
+        'title': _sanitize_title(caption),
+        'ext': 'mp4' if is_video else 'jpg',
+        'is_video': is_video,
+    }
+
+
+class _MediaUrlScanner:
+    """
+    Incremental scanner for Instagram post pages. Fed decoded chunks as they
+    stream in; only candidate tokens are unescaped, and `done` flips once the
+    title and the carousel's URLs (or, with no carousel marker in sight, the
+    single post's first media URL) have been seen so the caller can stop reading.
+    """
+
+    _URL_RE = re.compile(r'"(?:display_url|src)"\s*:\s*"([^"]+)"')
+    _OG_IMAGE_RE = re.compile(r'<meta property="og:image" content="([^"]+)"')
+    _OG_TITLE_RE = re.compile(r'<meta property="og:title" content="([^"]+)"')
+    _COUNT_RE = re.compile(r'"carousel_media_count"\s*:\s*(\d+)')
+    _CAROUSEL_RE = re.compile(r'"(?:carousel_media|carousel_media_count|edge_sidecar_to_children)"\s*:')
+    _OVERLAP = 4096  # Longest token we expect to straddle two chunks
+
+    def __init__(self):
+        self._tail = ""
+        self._urls: dict[str, None] = {}  # Order-preserving set
+        self._strict: dict[str, None] = {}
+        self.og_image: str | None = None
+        self.title: str | None = None
+        self.expected: int | None = None
+        self.carousel = False
+
+    @staticmethod
+    def _unescape(token: str) -> str:
+        if '\\' not in token:
+            return token
+        try:
+            return json.loads(f'"{token}"')
+        except ValueError:
+            return token.replace('\\/', '/')
+
+    def feed(self, text: str) -> bool:
+        buffer = self._tail + text
+        for match in self._URL_RE.finditer(buffer):
+            u = self._unescape(match.group(1))
+            if u.startswith('http') and 'scontent' in u and u not in self._urls:
+                self._urls[u] = None
+                if '/v/' in u and '.jpg' in u:
+                    self._strict[u] = None
+        if self.og_image is None:
+            match = self._OG_IMAGE_RE.search(buffer)
+            if match:
+                self.og_image = html_lib.unescape(match.group(1))
+        if self.title is None:
+            match = self._OG_TITLE_RE.search(buffer)
+            if match:
+                self.title = html_lib.unescape(match.group(1)).split('•')[0].strip()
+        if self.expected is None:
+            match = self._COUNT_RE.search(buffer)
+            if match:
+                self.expected = int(match.group(1))
+        if not self.carousel:
+            self.carousel = self.expected is not None or bool(self._CAROUSEL_RE.search(buffer))
+        self._tail = buffer[-self._OVERLAP:]
+        return self.done
+
+    @property
+    def done(self) -> bool:
+        if self.title is None or not self._strict:
+            return False
+        if not self.carousel:
+            return True  # Single post: the first full-size image is the media
+        return self.expected is not None and len(self._strict) >= self.expected
+
+    def result(self) -> dict | None:
+        # High-res Instagram images often have 1080x1080 or are from scontent*
+        unique_urls = list(self._strict) or list(self._urls)
+        if self.expected:
+            unique_urls = unique_urls[:self.expected]
+        if not unique_urls and self.og_image:
+            unique_urls = [self.og_image]
+        if not unique_urls:
+            return None
+
+        logger.info("Instagram Image Fallback: Found %d images via HTML scraping!", len(unique_urls))
+        return {
+            'direct_url': unique_urls[0],
+            'media_urls': unique_urls,
+            'title': _sanitize_title(self.title or "Instagram Image"),
+            'ext': 'jpg',
+            'is_video': False,
+        }
+
+
+def _fetch_instagram_candidate(api_url: str, headers: dict, cookies: YoutubeDLCookieJar | None,
+                               timeout: float, cancelled: threading.Event, stage_name: str,
+                               records: list | None) -> dict | None:
+    """Fetch and parse one candidate endpoint; bail out early once a rival has won."""
+    stage = _Stage(stage_name)
+    try:
+        with _stage(stage_name, records) as stage:
+            result = _fetch_instagram_candidate_body(api_url, headers, cookies, timeout, cancelled)
+            if result is None:
+                stage.outcome = "cancelled" if cancelled.is_set() else "rejected"
+        return result
+    except Exception as e:
+        if not _is_upstream_fault(e):
+            stage.outcome = "rejected"
+        raise
+    finally:
+        strategy_breakers.record("instagram", stage_name, stage.outcome, stage.seconds)
+
+
+def _fetch_instagram_candidate_body(api_url: str, headers: dict, cookies: YoutubeDLCookieJar | None,
+                                    timeout: float, cancelled: threading.Event) -> dict | None:
+    logger.info("Instagram Image Fallback: Trying %s", api_url)
+    resp = _http_session().get(
+        api_url, headers=headers, cookies=cookies, timeout=timeout, stream=True
+    )
+    try:
+        logger.info("Instagram Image Fallback: Status %s", resp.status_code)
+        _raise_for_upstream(resp.status_code, api_url)
+        if resp.status_code != 200:
+            return None
+
+        if 'text/html' in resp.headers.get('Content-Type', ''):
+            scanner = _MediaUrlScanner()
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            read = 0
+            for chunk in resp.iter_content(chunk_size=64 * 1024):
+                if cancelled.is_set():
+                    return None
+                read += len(chunk)
+                if scanner.feed(decoder.decode(chunk)) or read >= INSTAGRAM_HTML_MAX_BYTES:
+                    break
+            return scanner.result()
+
+        body = bytearray()
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            if cancelled.is_set():
+                return None
+            body += chunk
+        try:
+            return _parse_instagram_json(json.loads(body))
+        except ValueError:
+            return None
+    finally:
+        resp.close()
+
+
+_INSTAGRAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
+    'X-IG-App-ID': '936619743392459',
+    'X-Requested-With': 'XMLHttpRequest',
+}
+
+
+def _instagram_shortcode(url: str) -> str | None:
+    match = re.search(r'/p/([^/?]+)', url) or re.search(r'/reel/([^/?]+)', url)
+    return match.group(1) if match else None
+
+
+def _fetch_instagram_oembed(shortcode: str, timeout: float) -> dict | None:
+    """
+    OEmbed API (public posts only, no auth needed); thumbnail only.
+    Raises on upstream faults so the caller's breaker sees them.
+    """
+    try:
+        oembed_url = f'{INSTAGRAM_BASE_URL}/api/v1/oembed/?url=https://www.instagram.com/p/{shortcode}/'
+        logger.info("Instagram Image Fallback: Trying OEmbed %s", oembed_url)
+        with _stage("ig_oembed") as stage:
+            stage.outcome = "rejected"
+            resp = _http_session().get(oembed_url, headers=_INSTAGRAM_HEADERS, timeout=timeout)
+            _raise_for_upstream(resp.status_code, oembed_url)
+            if resp.status_code == 200:
+                data = resp.json()
+                thumbnail = data.get('thumbnail_url')
+                if thumbnail:
+                    stage.ok = True
+                    logger.info("Instagram Image Fallback: Found thumbnail via OEmbed!")
+                    return {
+                        'direct_url': thumbnail,
+                        'title': _sanitize_title(data.get('title', 'Instagram Image')),
+                        'ext': 'jpg',
+                        'is_video': False,
+                    }
+    except Exception as e:
+        if _is_upstream_fault(e):
+            raise
+        logger.warning("Instagram OEmbed API failed: %s", e)
+    return None
+
+
+def _race_instagram_candidates(shortcode: str, cookies: YoutubeDLCookieJar | None,
+                               timeout: float, fetched: set[str] = frozenset()) -> dict | None:
+    """
+    Try Instagram's GraphQL API with cookies (works for private posts too).
+    Candidates with a closed breaker are fetched concurrently; the first
+    usable answer wins. URLs in `fetched` were already tried by this request.
+    """
+    api_urls = {
+        'ig_api_dis': f'{INSTAGRAM_BASE_URL}/p/{shortcode}/?__a=1&__d=dis',
+        'ig_api': f'{INSTAGRAM_BASE_URL}/p/{shortcode}/?__a=1',
+        'ig_page': f'{INSTAGRAM_BASE_URL}/p/{shortcode}/', # Main page fallback
+    }
+    for name in list(api_urls):
+        if api_urls[name] in fetched:
+            _skip_stage(name)
+            del api_urls[name]
+        elif not strategy_breakers.allow("instagram", name):
+            _skip_stage(name, "breaker_open")
+            del api_urls[name]
+    if not api_urls:
+        return None
+
+    records = getattr(_trace, "records", None)
+    cancelled = threading.Event()
+    futures = {
+        _race_executor().submit(
+            _fetch_instagram_candidate, api_url, _INSTAGRAM_HEADERS, cookies, timeout,
+            cancelled, name, records
+        ): api_url
+        for name, api_url in api_urls.items()
+    }
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=timeout + 1):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning("Instagram Fallback API failed for %s: %s", futures[future], e)
+                continue
+            if result:
+                return result
+    except concurrent.futures.TimeoutError:
+        logger.warning("Instagram Fallback API race timed out for %s", shortcode)
+    finally:
+        cancelled.set()
+        for future in futures:
+            future.cancel()
+    return None
+
+
+# =====================
+# Extraction Result Cache
+# =====================
+
+EXTRACT_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACT_CACHE_MAX_ENTRIES", "512"))
+EXTRACT_CACHE_MAX_BYTES = int(os.getenv("EXTRACT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+EXTRACT_CACHE_DEFAULT_TTL = int(os.getenv("EXTRACT_CACHE_DEFAULT_TTL", "300"))
+EXTRACT_CACHE_MAX_TTL = int(os.getenv("EXTRACT_CACHE_MAX_TTL", "3600"))
+# Hand out links with at least this much life left
+EXTRACT_CACHE_EXPIRY_MARGIN = int(os.getenv("EXTRACT_CACHE_EXPIRY_MARGIN", "120"))
+
+# Share/tracking parameters that never select content on the platforms below;
+# elsewhere names like `source` or `ref` may, so only utm_*/fbclid/gclid go
+_TRACKING_PARAMS = {
+    "igsh", "igshid", "si", "feature", "fbclid", "gclid", "ref",
+    "_r", "_t", "is_from_webapp", "sender_device", "sender_web_id",
+    "share_app_id", "share_link_id", "share_item_id", "tt_from", "u_code",
+    "timestamp", "source", "web_id", "checksum", "sec_user_id",
+    "social_sharing", "preview_pb", "mibextid", "pp", "embeds_referring_euri",
+}
+_GLOBAL_TRACKING_PARAMS = {"fbclid", "gclid"}
+_TRACKING_PARAM_HOSTS = ("instagram.com", "tiktok.com", "youtube.com", "youtu.be", "facebook.com", "fb.watch")
+_SHORT_LINK_HOSTS = ("vt.tiktok.com", "vm.tiktok.com")
+_INSTAGRAM_SHORTCODE_RE = re.compile(r'^/(?:[^/]+/)?(?:p|reel|reels|tv)/([A-Za-z0-9_-]+)')
+_YOUTUBE_PATH_ID_RE = re.compile(r'^/(?:shorts|live|embed)/([A-Za-z0-9_-]+)')
+_PATH_EXPIRE_RE = re.compile(r'/expire/(\d+)/')
+
+_short_links: OrderedDict[str, str] = OrderedDict()
+_short_links_lock = threading.Lock()
+
+
+def _remember_short_link(url: str, resolved: str) -> None:
+    with _short_links_lock:
+        _short_links[url] = resolved
+        while len(_short_links) > EXTRACT_CACHE_MAX_ENTRIES:
+            _short_links.popitem(last=False)
+
+
+def _resolve_short_link(url: str) -> str:
+    """
+    Follow TikTok short-link and Instagram share-link redirects once and
+    remember the target, in memory and in the on-disk link index.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    host = (parsed.hostname or "").lower()
+    is_short = host in _SHORT_LINK_HOSTS or (
+        host.endswith("tiktok.com") and parsed.path.startswith("/t/")
+    ) or (
+        host.endswith("instagram.com") and parsed.path.startswith("/share/")
+    )
+    if not is_short:
+        return url
+
+    with _short_links_lock:
+        if url in _short_links:
+            _short_links.move_to_end(url)
+            return _short_links[url]
+
+    resolved = link_index.resolve(url)
+    if resolved is not None:
+        _remember_short_link(url, resolved)
+        return resolved
+
+    try:
+        resp = _http_session().head(url, allow_redirects=True, timeout=5)
+        resolved = resp.url or url
+    except Exception as e:
+        logger.warning("Short link resolution failed for %s: %s", url, e)
+        return url
+
+    _remember_short_link(url, resolved)
+    link_index.add_link(url, resolved)
+    logger.info("Resolved short link %s -> %s", url, resolved)
+    return resolved
+
+
+def _canonicalize_url(url: str) -> str:
+    """Normalize a media URL so equivalent share links map to one cache key."""
+    parsed = urllib.parse.urlsplit(url)
+    host = (parsed.hostname or "").lower()
+    known = any(host == d or host.endswith("." + d) for d in _TRACKING_PARAM_HOSTS)
+    if known:  # Elsewhere www./m. may well be different sites
+        for prefix in ("www.", "m.", "mobile."):
+            if host.startswith(prefix):
+                host = host[len(prefix):]
+                break
+    path = parsed.path or "/"
+    tracking = _TRACKING_PARAMS if known else _GLOBAL_TRACKING_PARAMS
+    query = [
+        (k, v) for k, v in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+        if k not in tracking and not k.startswith("utm_")
+    ]
+
+    if host.endswith("instagram.com"):
+        match = _INSTAGRAM_SHORTCODE_RE.match(path)
+        if match:
+            # img_index picks the carousel item, so it stays part of the key
+            index = [(k, v) for k, v in query if k == "img_index"]
+            suffix = "?" + urllib.parse.urlencode(index) if index else ""
+            return f"https://www.instagram.com/p/{match.group(1)}/{suffix}"
+    elif host == "youtu.be" or host.endswith("youtube.com"):
+        if host == "youtu.be":
+            host, path, query = "youtube.com", "/watch", [("v", path.strip("/"))] + query
+        match = _YOUTUBE_PATH_ID_RE.match(path)
+        if match:
+            path, query = "/watch", [("v", match.group(1))] + query
+        if path == "/watch":
+            # Start offsets don't change the media
+            query = [(k, v) for k, v in query if k in ("v", "list")]
+
+    query.sort()
+    return urllib.parse.urlunsplit(
+        ("https", host, path.rstrip("/") or "/", urllib.parse.urlencode(query), "")
+    )
+
+
+def _cache_key(url: str, request_cookies_b64: str | None) -> tuple[str, str]:
+    return _canonicalize_url(url), _cookie_fingerprint(request_cookies_b64)
+
+
+def _url_expiry(url: str) -> float | None:
+    """Read the expiry timestamp embedded in a signed CDN URL, if any."""
+    try:
+        parsed = urllib.parse.urlsplit(url)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        if "oe" in params:  # Instagram / Facebook CDN, hex unix time
+            return float(int(params["oe"], 16))
+        for name in ("expire", "x-expires", "Expires"):
+            if name in params:
+                return float(params[name])
+        match = _PATH_EXPIRE_RE.search(parsed.path)
+        if match:  # YouTube manifest URLs carry it in the path
+            return float(match.group(1))
+    except (ValueError, TypeError):
+        pass
+    return None
+
+
+def _result_ttl(result: dict) -> float:
+    """TTL for a result: until its first signed URL expires, capped."""
+    urls = [result.get("direct_url")] + list(result.get("media_urls") or [])
+    expiries = [e for e in (_url_expiry(u) for u in urls if u) if e is not None]
+    if not expiries:
+        return EXTRACT_CACHE_DEFAULT_TTL
+    ttl = min(expiries) - time.time() - EXTRACT_CACHE_EXPIRY_MARGIN
+    return min(ttl, EXTRACT_CACHE_MAX_TTL)
+
+
+class ExtractionCache:
+    """
+    Thread-safe LRU of /extract results, bounded by entry count and size.
+    With a shared state backend, entries are also stored there under
+    `namespace`, so other workers can serve them; the LRU stays in front.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, namespace: str | None = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.namespace = namespace if state_backend is not None else None
+        self._entries: OrderedDict[tuple, tuple[float, int, dict]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _shared_key(self, key: tuple) -> str:
+        return f"{self.namespace}:" + "|".join(key)
+
+    def get(self, key: tuple) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                self._drop(key)
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return dict(entry[2])
+        if self.namespace is not None:
+            result = self._get_shared(key)
+            if result is not None:
+                return result
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _get_shared(self, key: tuple) -> dict | None:
+        shared_key = self._shared_key(key)
+        try:
+            raw = state_backend.get(shared_key)
+            expires_at = state_backend.expires_at(shared_key) if raw is not None else None
+        except _STATE_ERRORS as e:
+            logger.warning("Shared cache read failed: %s", e)
+            return None
+        if raw is None or expires_at is None:
+            return None
+        result = json.loads(raw)
+        self._store(key, result, expires_at, len(raw))
+        with self._lock:
+            self.shared_hits += 1
+        return dict(result)
+
+    def put(self, key: tuple, result: dict, ttl: float | None = None) -> None:
+        ttl = _result_ttl(result) if ttl is None else ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        raw = json.dumps(result, default=str)
+        if len(raw) > self.max_bytes:
+            return
+        self._store(key, result, time.time() + ttl, len(raw))
+        if self.namespace is not None:
+            try:
+                state_backend.set(self._shared_key(key), raw, ttl)
+            except _STATE_ERRORS as e:
+                logger.warning("Shared cache write failed: %s", e)
+
+    def _store(self, key: tuple, result: dict, expires_at: float, size: int) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (expires_at, size, dict(result))
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def _drop(self, key: tuple) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+extraction_cache = ExtractionCache(EXTRACT_CACHE_MAX_ENTRIES, EXTRACT_CACHE_MAX_BYTES, "extract")
+
+
+# =====================
+# Link Index
+# =====================
+
+# On-disk index of resolved share links and per-media metadata; empty disables it
+LINK_INDEX_PATH = os.getenv("LINK_INDEX_PATH", "data/link_index.sqlite3")
+LINK_INDEX_MAX_ENTRIES = int(os.getenv("LINK_INDEX_MAX_ENTRIES", "100000"))
+LINK_INDEX_FLUSH_SECONDS = float(os.getenv("LINK_INDEX_FLUSH_SECONDS", "1"))
+
+_TIKTOK_VIDEO_ID_RE = re.compile(r'^/@[^/]+/(?:video|photo)/(\d+)')
+
+
+def _media_identity(url: str) -> tuple[str, str] | None:
+    """(platform, media ID) for a post URL, or None if it doesn't name one."""
+    parsed = urllib.parse.urlsplit(_canonicalize_url(url))
+    platform = _platform(url)
+    if platform == "youtube":
+        media_id = dict(urllib.parse.parse_qsl(parsed.query)).get("v")
+        return (platform, media_id) if media_id else None
+    if platform == "instagram":
+        match = _INSTAGRAM_SHORTCODE_RE.match(parsed.path)
+    elif platform == "tiktok":
+        match = _TIKTOK_VIDEO_ID_RE.match(parsed.path)
+    else:
+        return None
+    return (platform, match.group(1)) if match else None
+
+
+class LinkIndex:
+    """
+    SQLite map from short/share links to the URL they redirect to, plus the
+    stable metadata of the media behind them, so lookups skip the redirect
+    round trip across restarts. Opened on first use; writes are queued and
+    applied in batches by a background thread, and the least recently used
+    rows are dropped once a table outgrows `max_entries`.
+    """
+
+    def __init__(self, path: str, max_entries: int, flush_seconds: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_seconds = flush_seconds
+        self._local = threading.local()
+        self._ready = False
+        self._open_lock = threading.Lock()
+        self._pending: dict[tuple, tuple] = {}  # Latest write per row, coalesced
+        self._pending_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._writer: threading.Thread | None = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.compactions = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA auto_vacuum=INCREMENTAL")  # Only takes effect on a new file
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(f"PRAGMA mmap_size={STATE_SQLITE_MMAP_BYTES}")
+            self._local.db = db
+        return db
+
+    def open(self) -> bool:
+        """Create the file and schema once; disables the index if that fails."""
+        if self._ready or not self.enabled:
+            return self._ready
+        with self._open_lock:
+            if self._ready or not self.enabled:
+                return self._ready
+            try:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                db = self._db()
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS links (url TEXT PRIMARY KEY, target TEXT NOT NULL,"
+                    " platform TEXT, media_id TEXT, used_at REAL NOT NULL)"
+                )
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS media (platform TEXT, media_id TEXT, title TEXT,"
+                    " media_type TEXT, media_count INTEGER, used_at REAL NOT NULL,"
+                    " PRIMARY KEY (platform, media_id))"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS links_used_at ON links (used_at)")
+                db.execute("CREATE INDEX IF NOT EXISTS media_used_at ON media (used_at)")
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Link index disabled, cannot open %s: %s", self.path, e)
+                self.path = ""
+                return False
+            self._ready = True
+            return True
+
+    def resolve(self, url: str) -> str | None:
+        """Where a short link was last seen to redirect, if known."""
+        if not self.open():
+            return None
+        with self._pending_lock:
+            row = self._pending.get(("link", url))
+        if row is None:
+            try:
+                row = self._db().execute("SELECT target FROM links WHERE url = ?", (url,)).fetchone()
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning("Link index lookup failed: %s", e)
+                return None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._queue(("touch", url), (time.time(), url))
+        return row[0]
+
+    def media(self, url: str) -> dict | None:
+        """Stable metadata recorded for the media a URL points at."""
+        identity = _media_identity(url)
+        if identity is None or not self.open():
+            return None
+        try:
+            row = self._db().execute(
+                "SELECT title, media_type, media_count FROM media WHERE platform = ? AND media_id = ?",
+                identity,
+            ).fetchone()
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning("Link index lookup failed: %s", e)
+            return None
+        if row is None:
+            return None
+        return {"platform": identity[0], "media_id": identity[1],
+                "title": row[0], "media_type": row[1], "media_count": row[2]}
+
+    def add_link(self, url: str, target: str) -> None:
+        """Remember a redirect, if it landed on a post (not e.g. a login page)."""
+        identity = _media_identity(target)
+        if identity is not None and self.enabled:
+            self._queue(("link", url), (target, identity[0], identity[1], time.time()))
+
+    def note_media(self, url: str, result: dict) -> None:
+        """Record the title, media type and item count of an extracted post."""
+        identity = _media_identity(url)
+        # A thumbnail-only answer doesn't say whether the post is a video
+        if identity is not None and self.enabled and result.get("served_by") != "ig_oembed":
+            count = len(result.get("media_urls") or ()) or 1
+            row = (*identity, result.get("title"), result.get("media_type"), count, time.time())
+            self._queue(("media", *identity), row)
+
+    def _queue(self, key: tuple, row: tuple) -> None:
+        with self._pending_lock:
+            self._pending[key] = row
+            if self._writer is None and not self._stopped:
+                self._writer = threading.Thread(target=self._run, name="link-index", daemon=True)
+                self._writer.start()
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wake.wait()
+            time.sleep(self.flush_seconds)  # Let a batch build up
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        """Apply queued writes in one transaction, then compact if over budget."""
+        with self._pending_lock:
+            batch, self._pending = self._pending, {}
+        if not batch or not self.open():
+            return
+        links = [(key[1], *row) for key, row in batch.items() if key[0] == "link"]
+        touches = [row for key, row in batch.items() if key[0] == "touch"]
+        media = [row for key, row in batch.items() if key[0] == "media"]
+        db = self._db()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany(
+                    "INSERT OR REPLACE INTO links (url, target, platform, media_id, used_at)"
+                    " VALUES (?, ?, ?, ?, ?)", links,
+                )
+                db.executemany("UPDATE links SET used_at = MAX(used_at, ?) WHERE url = ?", touches)
+                db.executemany(
+                    "INSERT OR REPLACE INTO media (platform, media_id, title, media_type, media_count,"
+                    " used_at) VALUES (?, ?, ?, ?, ?, ?)", media,
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            self.writes += len(batch)
+            self._compact(db)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning("Link index write of %d rows failed: %s", len(batch), e)
+
+    def _compact(self, db: sqlite3.Connection) -> None:
+        # Trim to 90% so compaction doesn't run on every flush once full
+        keep = int(self.max_entries * 0.9)
+        dropped = 0
+        for table in ("links", "media"):
+            (count,) = db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+            if count > self.max_entries:
+                dropped += db.execute(
+                    f"DELETE FROM {table} WHERE rowid IN"
+                    f" (SELECT rowid FROM {table} ORDER BY used_at LIMIT ?)", (count - keep,)
+                ).rowcount
+        if dropped:
+            self.compactions += 1
+            db.execute("PRAGMA incremental_vacuum")
+            logger.info("Link index compacted: dropped %d least recently used rows", dropped)
+
+    def close(self) -> None:
+        """Stop the writer and flush what is still queued."""
+        self._stopped = True
+        self._wake.set()
+        if self._writer is not None:
+            self._writer.join(timeout=self.flush_seconds + 5)
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "pending": pending,
+            "writes": self.writes,
+            "compactions": self.compactions,
+            "errors": self.errors,
+        }
+
+
+link_index = LinkIndex(LINK_INDEX_PATH, LINK_INDEX_MAX_ENTRIES, LINK_INDEX_FLUSH_SECONDS)
+
+
+# =====================
+# Extraction Worker Pool
+# =====================
+
+EXTRACT_EXECUTOR = os.getenv("EXTRACT_EXECUTOR", "thread").lower()  # thread | process
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(min(8, (os.cpu_count() or 1) * 2))))
+EXTRACT_QUEUE_SIZE = int(os.getenv("EXTRACT_QUEUE_SIZE", "32"))
+EXTRACT_QUEUE_TIMEOUT = float(os.getenv("EXTRACT_QUEUE_TIMEOUT", "20"))
+
+
+def _run_pool_job(fn, enqueued_at: float, queue_timeout: float, *args) -> tuple:
+    """
+    Worker-side wrapper. Returns a plain tuple instead of raising so results,
+    HTTP errors, the stage trace and sampled stacks survive the trip back
+    from a process pool.
+    """
+    waited = max(time.time() - enqueued_at, 0.0)
+    if waited > queue_timeout:
+        records = [("queue_wait", waited, "failure")]
+        return ("error", 503, "Server busy, extraction timed out in queue.", {"Retry-After": "5"}, records, None)
+
+    records = [("queue_wait", waited, "success")]
+    _trace.records = records
+    sampling = SLOW_REQUEST_SECONDS > 0
+    if sampling:
+        request_sampler.begin()
+    try:
+        outcome = ("ok", fn(*args), records)
+    except HTTPException as e:
+        outcome = ("error", e.status_code, e.detail, e.headers, records)
+    finally:
+        _trace.records = None
+        stacks = request_sampler.end() if sampling else None
+    return (*outcome, stacks)
+
+
+def _warm_worker() -> int:
+    ydl_pool.warm()
+    return os.getpid()
+
+
+class ExtractionPool:
+    """Bounded executor for extraction jobs with fast 503 rejection."""
+
+    def __init__(self, kind: str, workers: int, queue_size: int, queue_timeout: float):
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._executor = None
+        self._pending = 0  # queued + running, only touched on the event loop
+        self._avg_seconds = 5.0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="extract"
+                )
+        return self._executor
+
+    def warm(self) -> None:
+        """Start every worker process and let each build its own YoutubeDL pool."""
+        executor = self._get_executor()
+        if self.kind == "process":
+            concurrent.futures.wait([executor.submit(_warm_worker) for _ in range(self.workers)])
+
+    def _busy(self, detail: str) -> HTTPException:
+        backlog = max(self._pending - self.workers, 0) + 1
+        retry_after = min(max(int(self._avg_seconds * backlog / self.workers), 1), 30)
+        return HTTPException(
+            status_code=503, detail=detail, headers={"Retry-After": str(retry_after)}
+        )
+
+    async def run(self, fn, *args, trace: list | None = None, deadline: Deadline | None = None,
+                  stacks: dict | None = None):
+        """
+        Run `fn(*args)` on the pool; stage records are appended to `trace`
+        and, with slow-request capture on, sampled stacks added to `stacks`.
+        With a deadline, stop waiting once it passes (the job may still finish).
+        """
+        if self._pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise self._busy("Server busy, please retry shortly.")
+
+        started = time.monotonic()
+        future = self._get_executor().submit(
+            _run_pool_job, fn, time.time(), self.queue_timeout, *args
+        )
+        self._pending += 1
+        wrapped = asyncio.wrap_future(future)
+        wrapped.add_done_callback(self._release)
+
+        queue_timeout = self.queue_timeout
+        if deadline is not None:
+            queue_timeout = min(queue_timeout, deadline.remaining())
+        done, _ = await asyncio.wait({wrapped}, timeout=queue_timeout)
+        if not done and future.cancel():
+            self.timed_out += 1
+            if trace is not None:
+                trace.append(("queue_wait", time.monotonic() - started, "failure"))
+            raise self._busy("Server busy, extraction timed out in queue.")
+        if not done and deadline is not None:
+            done, _ = await asyncio.wait({wrapped}, timeout=deadline.remaining() + 1.0)
+            if not done:
+                if trace is not None:
+                    trace.append(("deadline", time.monotonic() - started, "failure"))
+                raise HTTPException(status_code=504, detail="Extraction deadline exceeded.")
+        outcome = await wrapped
+
+        self.completed += 1
+        self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * (time.monotonic() - started)
+        *outcome, records, sampled = outcome
+        if trace is not None:
+            trace.extend(records)
+        if stacks is not None and sampled:
+            stacks.update(sampled)
+        if outcome[0] == "error":
+            _, status_code, detail, headers = outcome
+            if status_code == 503:
+                self.timed_out += 1
+            raise HTTPException(status_code=status_code, detail=detail, headers=headers)
+        return outcome[1]
+
+    def _release(self, future: asyncio.Future) -> None:
+        self._pending -= 1
+        if not future.cancelled():
+            future.exception()  # Mark retrieved if nobody awaited it
+
+    def stats(self) -> dict:
+        running = min(self._pending, self.workers)
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "running": running,
+            "queued": self._pending - running,
+            "queue_capacity": self.queue_size,
+            "utilization": round(running / self.workers, 3) if self.workers else 0.0,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+extraction_pool = ExtractionPool(
+    EXTRACT_EXECUTOR, EXTRACT_WORKERS, EXTRACT_QUEUE_SIZE, EXTRACT_QUEUE_TIMEOUT
+)
+
+
+# =====================
+# Single-Flight Coalescing
+# =====================
+
+EXTRACT_SINGLEFLIGHT_MAX_WAITERS = int(os.getenv("EXTRACT_SINGLEFLIGHT_MAX_WAITERS", "64"))
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers of the same key."""
+
+    def __init__(self, max_waiters: int):
+        self.max_waiters = max_waiters
+        self._calls: dict[tuple, asyncio.Task] = {}
+        self._waiters: dict[tuple, int] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    async def do(self, key: tuple, fn):
+        task = self._calls.get(key)
+        if task is not None:
+            if self._waiters[key] >= self.max_waiters:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="Too many pending requests for this URL. Retry shortly.",
+                    headers={"Retry-After": "1"},
+                )
+            self._waiters[key] += 1
+            self.coalesced += 1
+        else:
+            # Run in its own task so a disconnecting leader can't cancel followers
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            self._waiters[key] = 0
+            self.leaders += 1
+            task.add_done_callback(lambda t: self._finish(key, t))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: tuple, task: asyncio.Task) -> None:
+        self._calls.pop(key, None)
+        self._waiters.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # Mark retrieved when nobody was waiting
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+        }
+
+
+extraction_flight = SingleFlight(EXTRACT_SINGLEFLIGHT_MAX_WAITERS)
+
+
+# =====================
+# YoutubeDL Instance Pool
+# =====================
+
+YDL_POOL_MAX_IDLE = int(os.getenv("YDL_POOL_MAX_IDLE", str(EXTRACT_WORKERS)))
+YDL_POOL_WARM = os.getenv("YDL_POOL_WARM", "1") == "1"
+YDL_PROFILES = ("generic", "social", "tiktok")
+# Full yt-dlp output is costly; enable only while debugging
+EXTRACT_VERBOSE = os.getenv("EXTRACT_VERBOSE", "0") == "1"
+# Fraction of requests that log every candidate URL/format
+EXTRACT_DEBUG_SAMPLE_RATE = float(os.getenv("EXTRACT_DEBUG_SAMPLE_RATE", "0"))
+
+
+def _ydl_profile(url: str) -> str:
+    """Pick the option profile for a URL."""
+    lowered = url.lower()
+    if "tiktok.com" in lowered:
+        return "tiktok"
+    if "instagram.com" in lowered:
+        return "social"
+    return "generic"
+
+
+def _ydl_options(profile: str) -> dict:
+    """Build the YoutubeDL options shared by every instance of a profile."""
+    ydl_opts = {
+        "quiet": not EXTRACT_VERBOSE,
+        "verbose": EXTRACT_VERBOSE,
+        "ignoreerrors": True,
+        "noplaylist": profile == "generic",
+        "playlistend": PLAYLIST_PAGE_MAX,  # Unpaged requests resolve at most one page
+        "extract_flat": False,
+        "skip_download": True,
+        "nocheckcertificate": True, # Disable SSL checks to avoid handshake timeouts
+        # Allow selecting 'none' video formats (images)
+        "writethumbnail": True,
+        "ignore_no_formats_error": True, # Key fix for Instagram images
+
+        "user_agent": (
+            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) "
+            "Chrome/120.0.0.0 Safari/537.36"
+        ),
+        "extractor_args": {
+            "youtube": {
+                "player_client": ["android", "web"],
+                "player_skip": ["web_safari", "web_creator"],
+            }
+        },
+        "http_headers": {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
+            "Accept-Language": "en-US,en;q=0.9",
+            "Sec-Fetch-Mode": "navigate",
+            "Sec-Fetch-Site": "none",
+            "Sec-Fetch-Dest": "document",
+            "Upgrade-Insecure-Requests": "1",
+        },
+    }
+
+    # Only use impersonation (curl_cffi) for TikTok
+    if profile == "tiktok" and ImpersonateTarget:
+        ydl_opts["impersonate"] = ImpersonateTarget(client="chrome")
+
+    return ydl_opts
+
+
+@contextlib.contextmanager
+def _override_params(ydl: yt_dlp.YoutubeDL, **params):
+    """Temporarily change options on a pooled YoutubeDL instance."""
+    saved = {k: ydl.params.get(k) for k in params}
+    ydl.params.update(params)
+    try:
+        yield ydl
+    finally:
+        ydl.params.update(saved)
+
+
+@contextlib.contextmanager
+def _socket_timeout(ydl: yt_dlp.YoutubeDL, seconds: float):
+    """Temporarily cap network timeouts on a pooled instance and its request handlers."""
+    handlers = list(ydl._request_director.handlers.values())
+    saved = [h.timeout for h in handlers]
+    with _override_params(ydl, socket_timeout=seconds):
+        for h in handlers:
+            h.timeout = seconds
+        try:
+            yield ydl
+        finally:
+            for h, timeout in zip(handlers, saved):
+                h.timeout = timeout
+
+
+class YoutubeDLPool:
+    """
+    Idle YoutubeDL instances per option profile. Reusing them skips extractor
+    and request-director setup and keeps CDN connections alive.
+    """
+
+    def __init__(self, max_idle: int):
+        self.max_idle = max_idle
+        self._idle: dict[str, list[yt_dlp.YoutubeDL]] = {p: [] for p in YDL_PROFILES}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _build(self, profile: str) -> yt_dlp.YoutubeDL:
+        _load_dependencies()
+        ydl = yt_dlp.YoutubeDL(_ydl_options(profile))
+        ydl._request_director  # Build request handlers (curl_cffi for TikTok) up front
+        with self._lock:
+            self.created += 1
+        return ydl
+
+    @contextlib.contextmanager
+    def checkout(self, profile: str, cookies: YoutubeDLCookieJar | None = None):
+        with _stage("ydl_setup"):
+            with self._lock:
+                idle = self._idle[profile]
+                ydl = idle.pop() if idle else None
+                if ydl is not None:
+                    self.reused += 1
+            if ydl is None:
+                ydl = self._build(profile)
+
+        # Cookies are per request: never let one caller's session leak to the next
+        ydl.cookiejar.clear()
+        try:
+            for cookie in cookies or ():
+                ydl.cookiejar.set_cookie(cookie)
+            yield ydl
+        finally:
+            ydl.cookiejar.clear()
+            with self._lock:
+                idle = self._idle[profile]
+                if len(idle) < self.max_idle:
+                    idle.append(ydl)
+                    ydl = None
+            if ydl is not None:
+                ydl.close()
+
+    def warm(self) -> None:
+        """Pre-build one instance per profile."""
+        for profile in YDL_PROFILES:
+            try:
+                ydl = self._build(profile)
+            except Exception as e:
+                logger.warning("YoutubeDL warm-up failed for %s: %s", profile, e)
+                continue
+            with self._lock:
+                self._idle[profile].append(ydl)
+        logger.info("YoutubeDL pool warmed: %s", ", ".join(YDL_PROFILES))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "idle": {p: len(v) for p, v in self._idle.items()},
+                "created": self.created,
+                "reused": self.reused,
+            }
+
+
+ydl_pool = YoutubeDLPool(YDL_POOL_MAX_IDLE)
+
+
+EXTRACT_RATE_LIMIT = os.getenv("EXTRACT_RATE_LIMIT", "10/minute")
+# Also capped at EXTRACT_RATE_LIMIT's amount, since every item costs a hit
+EXTRACT_BATCH_MAX_ITEMS = int(os.getenv("EXTRACT_BATCH_MAX_ITEMS", "50"))
+EXTRACT_BATCH_PARALLELISM = int(os.getenv("EXTRACT_BATCH_PARALLELISM", "4"))
+
+
+async def _extract_shared(url: str, request_cookies_b64: str | None,
+                          deadline_ms: int | None = None, merge: bool = False,
+                          constraints: FormatConstraints | None = None,
+                          progress=None) -> dict:
+    """
+    Serve an extraction from cache, an in-flight call, or the worker pool.
+    The response lists the stages that ran and how long each took.
+    With `constraints`, the format is re-selected for the client; with
+    `merge`, split video/audio streams are muxed into the artifact cache.
+    `progress(phase)` is called as the request moves between phases.
+    """
+    report = progress or (lambda phase: None)
+    url = url.strip()
+    if not url.startswith("http"):
+        raise HTTPException(status_code=400, detail="Invalid URL. Must start with http(s).")
+
+    deadline = Deadline.for_request(deadline_ms)
+    report("resolving")
+    url = await run_in_threadpool(_resolve_short_link, url)
+    platform = _platform(url)
+    cache_key = _cache_key(url, request_cookies_b64)
+
+    def finish(result: dict):
+        return _finalize_result(result, request_cookies_b64, platform, constraints, merge, report)
+
+    cached = extraction_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Cache hit for %s", cache_key[0])
+        metrics.inc("video_downloader_requests_total", platform=platform, source="cache")
+        metrics.inc("video_downloader_served_total", platform=platform, path="cache")
+        cached["served_by"] = "cache"
+        cached["stages"] = [{"name": "cache", "ms": 0.0, "outcome": "success"}]
+        report("cache_hit")
+        return await finish(cached)
+
+    async def extract_and_cache() -> dict:
+        metrics.inc("video_downloader_requests_total", platform=platform, source="upstream")
+        trace, stacks = [], {}
+        started = time.perf_counter()
+        try:
+            result = await extraction_pool.run(
+                _extract_media, url, request_cookies_b64, deadline,
+                trace=trace, deadline=deadline, stacks=stacks,
+            )
+        finally:
+            _record_trace(platform, trace)
+            slow_requests.consider(url, platform, time.perf_counter() - started, trace, stacks)
+        metrics.inc("video_downloader_served_total", platform=platform, path=result.get("served_by"))
+        extraction_cache.put(cache_key, result)
+        link_index.note_media(url, result)
+        return {**result, "budget_ms": round(deadline.seconds * 1000), "stages": _stage_report(trace)}
+
+    report("extracting")
+    return await finish(dict(await extraction_flight.do(cache_key, extract_and_cache)))
+
+
+async def _finalize_result(result: dict, request_cookies_b64: str | None, platform: str,
+                           constraints: FormatConstraints | None, merge: bool, report) -> dict:
+    """Per-client steps on a (possibly shared) extraction result."""
+    if constraints is not None:
+        report("selecting")
+        _apply_format_selection(result, constraints)
+    if merge:
+        report("merging")
+        await _attach_merged_file(result, platform)
+    return _attach_stream_urls(result, request_cookies_b64)
+
+
+def _is_paged(video_request: VideoRequest) -> bool:
+    return video_request.limit is not None or video_request.cursor is not None
+
+
+def _request_key(video_request: VideoRequest) -> tuple:
+    """Identity of a request for batch and job de-duplication."""
+    r = video_request
+    constraints = r.constraints.model_dump_json() if r.constraints else None
+    paging = _page_bounds(r) if _is_paged(r) else None
+    return (r.url.strip(), r.cookies, r.merge, constraints, paging)
+
+
+def _request_cost(video_request: VideoRequest) -> int:
+    """Rate-limit hits for a request: one, or one per entry of a playlist page."""
+    return _page_bounds(video_request)[1] if _is_paged(video_request) else 1
+
+
+async def _extract_request(video_request: VideoRequest, deadline_ms: int | None = None,
+                           progress=None) -> dict:
+    r = video_request
+    if _is_paged(r):
+        return await _extract_page(r, deadline_ms, progress)
+    return await _extract_shared(r.url, r.cookies, deadline_ms, r.merge, r.constraints, progress)
+
+
+def _rate_limit_amount() -> int | None:
+    """Hits one /extract rate-limit window allows, or None if limiting is off."""
+    return parse_rate_limit(EXTRACT_RATE_LIMIT).amount if limiter.enabled else None
+
+
+def _batch_max_items() -> int:
+    """Largest batch accepted: every item costs a hit, so it must fit in one window."""
+    amount = _rate_limit_amount()
+    return EXTRACT_BATCH_MAX_ITEMS if amount is None else min(EXTRACT_BATCH_MAX_ITEMS, amount)
+
+
+def _charge_rate_limit(request: Request, cost: int) -> None:
+    """
+    Charge `cost` hits against the shared /extract rate-limit budget. A
+    rejected request is not charged: `hit` counts even when it refuses.
+    """
+    if not limiter.enabled:
+        return
+    item = parse_rate_limit(EXTRACT_RATE_LIMIT)
+    if cost > item.amount:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Request costs {cost} rate-limit hits, more than the limit of {item} allows.",
+        )
+    client = get_remote_address(request)
+    if (not limiter.limiter.test(item, client, "extract", cost=cost)
+            or not limiter.limiter.hit(item, client, "extract", cost=cost)):
+        reset_at = limiter.limiter.get_window_stats(item, client, "extract").reset_time
+        raise HTTPException(
+            status_code=429,
+            detail=f"Rate limit exceeded: {item}",
+            headers={"Retry-After": str(max(math.ceil(reset_at - time.time()), 1))},
+        )
+
+
+# --- Response encoding ---
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "5"))
+# Per-request diagnostics, left out of the ETag so a cache hit matches the original extraction
+_ETAG_VOLATILE_KEYS = ("stages", "budget_ms", "served_by")
+
+
+def _dump_json(body: dict, sort_keys: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(body, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(
+        body, ensure_ascii=False, allow_nan=False, separators=(",", ":"), sort_keys=sort_keys
+    ).encode()
+
+
+def _project(body: dict, fields: str | None) -> dict:
+    """Keep only the comma-separated top-level `fields`, if given."""
+    if not fields:
+        return body
+    wanted = {name.strip() for name in fields.split(",") if name.strip()}
+    return {key: value for key, value in body.items() if key in wanted}
+
+
+def _etag(body: dict) -> str:
+    stable = {key: value for key, value in body.items() if key not in _ETAG_VOLATILE_KEYS}
+    # Weak: the stages and the content coding may differ between equal responses
+    return f'W/"{hashlib.blake2b(_dump_json(stable, sort_keys=True), digest_size=16).hexdigest()}"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def _accepted_encoding(accept_encoding: str) -> str | None:
+    """Best coding we can produce that the client accepts: br, then gzip."""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip()] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def _encoded_response(request: Request, body: dict, fields: str | None = None) -> Response:
+    """
+    JSON response with a `fields` projection, an ETag that answers
+    If-None-Match with 304, and gzip/brotli for larger payloads.
+    """
+    body = _project(body, fields)
+    etag = _etag(body)
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "private, no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    content = _dump_json(body)
+    coding = _accepted_encoding(request.headers.get("accept-encoding", ""))
+    if coding and len(content) >= RESPONSE_COMPRESS_MIN_BYTES:
+        if coding == "br":
+            content = brotli.compress(content, quality=RESPONSE_BROTLI_QUALITY)
+        else:
+            content = gzip.compress(content, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+        headers["Content-Encoding"] = coding
+    return Response(content, media_type="application/json", headers=headers)
+
+
+@app.post("/extract")
+@limiter.shared_limit(EXTRACT_RATE_LIMIT, scope="extract")
+async def extract_info(video_request: VideoRequest, request: Request, fields: str | None = None):
+    """
+    Extract direct media URL and metadata.
+    Returns JSON with direct_url for client-side downloading.
+    With limit or cursor, returns one page of a playlist/carousel instead.
+    `fields=direct_url,media_type` trims the response to those keys;
+    send the ETag back in If-None-Match to get 304 when nothing changed.
+    """
+    cost = _request_cost(video_request)
+    if cost > 1:
+        _charge_rate_limit(request, cost - 1)  # The decorator charged the first hit
+    result = await _extract_request(video_request, video_request.deadline_ms)
+    return _encoded_response(request, result, fields)
+
+
+@app.post("/extract/batch")
+async def extract_batch(batch: BatchRequest, request: Request):
+    """
+    Extract many URLs concurrently. Streams one NDJSON line per unique URL
+    in completion order. Costs one rate-limit hit per unique URL (one per
+    entry for playlist pages).
+    """
+    if not batch.requests:
+        raise HTTPException(status_code=400, detail="Batch is empty.")
+    max_items = _batch_max_items()
+    if len(batch.requests) > max_items:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Batch too large (max {max_items} items).",
+        )
+
+    unique: dict[tuple, list[int]] = {}
+    for index, item in enumerate(batch.requests):
+        unique.setdefault(_request_key(item), []).append(index)
+    _charge_rate_limit(request, sum(_request_cost(batch.requests[i[0]]) for i in unique.values()))
+
+    parallelism = min(batch.parallelism or EXTRACT_BATCH_PARALLELISM, EXTRACT_BATCH_PARALLELISM)
+    semaphore = asyncio.Semaphore(max(parallelism, 1))
+
+    async def run_one(url: str, indexes: list[int]) -> dict:
+        line = {"indexes": indexes, "url": url}
+        item = batch.requests[indexes[0]]
+        async with semaphore:
+            try:
+                line.update(await _extract_request(item, item.deadline_ms or batch.deadline_ms))
+            except HTTPException as e:
+                line.update({"status": "error", "status_code": e.status_code, "detail": e.detail})
+            except Exception as e:
+                logger.error("Batch extraction failed for %s: %s", url, e)
+                line.update({"status": "error", "status_code": 500, "detail": str(e)})
+        return line
+
+    async def stream():
+        tasks = [
+            asyncio.ensure_future(run_one(key[0], indexes))
+            for key, indexes in unique.items()
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+class _ExtractionContext:
+    """Per-request state shared by the extraction strategies."""
+
+    def __init__(self, url: str, cookies: YoutubeDLCookieJar | None, deadline: Deadline):
+        self.url = url
+        self.cookies = cookies
+        self.deadline = deadline
+        self.platform = _platform(url)
+        self.profile = _ydl_profile(url)
+        self.info: dict | None = None  # Last yt-dlp info, kept for headers and errors
+        self.fetched: set[str] = set()  # Upstream URLs fast paths already requested
+
+
+def _extract_media(url: str, request_cookies_b64: str | None,
+                   deadline: Deadline | None = None) -> dict:
+    """
+    Run the extraction strategies for a URL (matching fast paths, then yt-dlp
+    and platform fallbacks by fidelity tier, healthiest first within a tier,
+    skipping breaker-open ones) within the request's deadline.
+    Raises HTTPException on failure.
+    """
+    deadline = deadline or Deadline(EXTRACT_DEADLINE_SECONDS)
+    logger.info("Cookies received: %s", "YES" if request_cookies_b64 else "NO")
+    ctx = _ExtractionContext(url, _get_cookie_jar(request_cookies_b64), deadline)
+    logger.info("Analyzing URL: %s", url)
+
+    for name, resolver, match in fast_paths.routes(url):
+        result = _run_fast_path(ctx, name, resolver, match)
+        if result is not None:
+            return result
+
+    strategies = PLATFORM_STRATEGIES.get(ctx.platform, DEFAULT_STRATEGIES)
+    known = link_index.media(url) if ctx.platform in IMAGE_POST_STRATEGIES else None
+    if known is not None and known["media_type"] == "image":
+        strategies = IMAGE_POST_STRATEGIES[ctx.platform]
+
+    ran_any = out_of_time = False
+    for name in strategy_breakers.order(ctx.platform, strategies):
+        if name == "extract_flat" and ctx.info is not None:
+            continue  # Full extraction already returned metadata
+        if not deadline.allows(name):
+            out_of_time = True
+            continue
+        if name in STRATEGY_GROUPS:
+            if strategy_breakers.all_open(ctx.platform, name):
+                _skip_stage(name, "breaker_open")
+                continue
+        elif not strategy_breakers.allow(ctx.platform, name):
+            _skip_stage(name, "breaker_open")
+            continue
+
+        ran_any = True
+        started = time.perf_counter()
+        # Only upstream faults count against a strategy; a URL with nothing to serve doesn't
+        outcome = "rejected"
+        try:
+            result = _STRATEGIES[name](ctx)
+            if result is not None:
+                outcome = "success"
+                result["served_by"] = name
+                return result
+        except HTTPException:
+            outcome = "success"  # Upstream answered; the content itself is unusable
+            raise
+        except Exception as e:
+            if _is_upstream_fault(e):
+                outcome = "failure"
+                logger.warning("Strategy %s failed upstream for %s: %s", name, url, e)
+            else:
+                import traceback
+                logger.error("Strategy %s failed: %s\n%s", name, str(e), traceback.format_exc())
+        finally:
+            if name not in STRATEGY_GROUPS:
+                strategy_breakers.record(ctx.platform, name, outcome, time.perf_counter() - started)
+
+    if not ran_any:
+        if out_of_time:
+            raise HTTPException(status_code=504, detail="Extraction deadline exceeded.")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Extraction for {ctx.platform} is temporarily unavailable. Try again shortly.",
+            headers={"Retry-After": str(max(int(BREAKER_COOLDOWN), 1))},
+        )
+    if ctx.info is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Could not extract info. The URL may be invalid or require login.",
+        )
+    raise HTTPException(
+        status_code=400,
+        detail="Could not find a direct media URL for this content.",
+    )
+
+
+class _YdlErrorLog:
+    """
+    yt-dlp logger for one extraction. With ignoreerrors, extraction errors are
+    reported rather than raised, so keep the exception being handled for each.
+    """
+
+    def __init__(self):
+        self.errors: list[BaseException] = []
+
+    def debug(self, msg: str) -> None:
+        if EXTRACT_VERBOSE:
+            logger.info("yt-dlp: %s", msg)
+
+    def warning(self, msg: str) -> None:
+        logger.warning("yt-dlp: %s", msg)
+
+    def error(self, msg: str) -> None:
+        self.errors.append(sys.exc_info()[1] or Exception(msg))
+        logger.warning("yt-dlp: %s", msg)
+
+
+def _try_ytdlp(ctx: _ExtractionContext, flat: bool = False) -> dict | None:
+    """Full (or metadata-only) yt-dlp extraction on a pooled instance."""
+    name = "extract_flat" if flat else "extract_info"
+    overrides = {"format": None, "extract_flat": True} if flat else {}
+    if flat:
+        logger.warning("Retrying with metadata-only options for Image...")
+
+    with ydl_pool.checkout(ctx.profile, ctx.cookies) as ydl:
+        errors = _YdlErrorLog()
+        with _stage(name) as stage, \
+                _override_params(ydl, logger=errors, **overrides), \
+                _socket_timeout(ydl, ctx.deadline.budget(name)):
+            try:
+                info = ydl.extract_info(ctx.url, download=False)
+            except yt_dlp.utils.DownloadError as e:
+                errors.errors.append(e)
+                info = None
+            if info is None:
+                fault = next((e for e in errors.errors if _is_upstream_fault(e)), None)
+                if fault is not None:
+                    raise fault
+                stage.outcome = "rejected"
+
+        logger.info("Extraction Result: %s", "None" if info is None else f"Found info with keys: {list(info.keys())}")
+        if info is None:
+            return None
+
+        ctx.info = info
+        with _stage("response_build") as stage:
+            result = _build_response(ctx.url, info, ydl.params.get("user_agent"))
+            stage.ok = result is not None
+        if result is not None:
+            # Session cookies yt-dlp picked up (e.g. TikTok's) are needed to fetch the media
+            result["_upstream_cookie"] = ydl.cookiejar.get_cookie_header(result["direct_url"])
+            for fmt in result.get("_formats") or ():
+                fmt["cookie"] = ydl.cookiejar.get_cookie_header(fmt["url"]) or None
+            for source in (result.get("_merge") or {}).get("sources", ()):
+                cookie = ydl.cookiejar.get_cookie_header(source["url"])
+                if cookie:
+                    source["headers"]["Cookie"] = cookie
+    return result
+
+
+def _instagram_response(ctx: _ExtractionContext, ig_result: dict) -> dict:
+    return {
+        "status": "success",
+        "title": ig_result['title'] or "Media",
+        "direct_url": ig_result['direct_url'],
+        "media_urls": ig_result.get('media_urls', [ig_result['direct_url']]),
+        "ext": ig_result['ext'],
+        "media_type": "video" if ig_result.get('is_video') else "image",
+        "headers": (ctx.info or {}).get("http_headers", {}),
+    }
+
+
+def _try_instagram_race(ctx: _ExtractionContext) -> dict | None:
+    """Instagram image fallback: use the direct API when yt-dlp fails."""
+    shortcode = _instagram_shortcode(ctx.url)
+    if not shortcode:
+        return None
+    logger.info("Trying Instagram Image API fallback...")
+    timeout = ctx.deadline.budget("ig_race", cap=INSTAGRAM_RACE_TIMEOUT)
+    ig_result = _race_instagram_candidates(shortcode, ctx.cookies, timeout, ctx.fetched)
+    return _instagram_response(ctx, ig_result) if ig_result else None
+
+
+def _try_instagram_oembed(ctx: _ExtractionContext) -> dict | None:
+    shortcode = _instagram_shortcode(ctx.url)
+    if not shortcode:
+        return None
+    ig_result = _fetch_instagram_oembed(shortcode, ctx.deadline.budget("ig_oembed", cap=10))
+    return _instagram_response(ctx, ig_result) if ig_result else None
+
+
+_STRATEGIES = {
+    "extract_info": _try_ytdlp,
+    "extract_flat": lambda ctx: _try_ytdlp(ctx, flat=True),
+    "ig_race": _try_instagram_race,
+    "ig_oembed": _try_instagram_oembed,
+}
+
+
+def _build_response(url: str, info: dict, user_agent: str | None) -> dict | None:
+    """Turn a yt-dlp info dict into the /extract payload, or None if it has no media URL."""
+    media_urls = []
+    # Handle carousels / playlists
+    if "entries" in info:
+        logger.info("Detected carousel/playlist with %d entries.", len(info["entries"]))
+        entries = list(info["entries"])
+        if not entries:
+            raise HTTPException(status_code=400, detail="Empty playlist/carousel.")
+        
+        # Process all entries to get URLs
+        for entry in entries:
+            # Try to get URL from entry directly or its formats
+            e_url = entry.get("url")
+            if not e_url:
+                # Try formats
+                ranked, _ = _rank_formats(_compact_formats(entry), FormatConstraints())
+                if ranked:
+                    e_url = ranked[0]["url"]
+                elif entry.get("formats"):
+                    e_url = entry["formats"][-1].get("url")
+            
+            if not e_url:
+                # Try thumbnail (singular) or thumbnails (list)
+                e_url = entry.get("thumbnail")
+                if not e_url:
+                    thumbnails = entry.get("thumbnails", [])
+                    if thumbnails:
+                        e_url = thumbnails[-1].get("url")
+            
+            if e_url:
+                media_urls.append(e_url)
+            else:
+                logger.warning("Could not find URL for entry in carousel")
+        
+        # Set info to first entry for metadata extraction
+        info = entries[0]
+
+    # Determine media type
+    is_video = True
+    if info.get("vcodec") == "none" or info.get("ext") in [
+        "jpg", "jpeg", "png", "webp", "heic",
+    ]:
+        is_video = False
+
+    formats = info.get("formats", [])
+    compact = _compact_formats(info)
+
+    # Debug: Log all possible URL sources (sampled, off by default)
+    if EXTRACT_DEBUG_SAMPLE_RATE and random.random() < EXTRACT_DEBUG_SAMPLE_RATE:
+        logger.info("DEBUG url=%s", info.get("url"))
+        logger.info("DEBUG thumbnail=%s", info.get("thumbnail"))
+        logger.info("DEBUG thumbnails=%s", info.get("thumbnails"))
+        logger.info("DEBUG formats count=%s", len(formats))
+        for i, f in enumerate(formats):
+            logger.info("DEBUG format[%d]: url=%s vcodec=%s ext=%s", i, f.get("url", "")[:80] if f.get("url") else "None", f.get("vcodec"), f.get("ext"))
+
+    # Get the best direct URL
+    direct_url = info.get("url")
+    http_headers = info.get("http_headers", {})
+
+    # If no URL selected by yt-dlp (split video/audio), rank the formats ourselves
+    if not direct_url:
+        ranked, _ = _rank_formats(compact, FormatConstraints())
+        if ranked:
+            direct_url = ranked[0]["url"]
+            http_headers = ranked[0]["headers"] or http_headers
+        elif formats:
+            direct_url = formats[-1].get("url")
+            if formats[-1].get("http_headers"):
+                http_headers = formats[-1].get("http_headers")
+
+    # Fallback: thumbnails list
+    if not direct_url:
+        thumbnails = info.get("thumbnails", [])
+        if thumbnails:
+            direct_url = thumbnails[-1].get("url")
+            is_video = False
+
+    # Fallback: thumbnail (singular key)
+    if not direct_url:
+        thumbnail = info.get("thumbnail")
+        if thumbnail:
+            direct_url = thumbnail
+            is_video = False
+
+    if not direct_url:
+        logger.error("No direct URL found. Full info dump: %s", {k: v for k, v in info.items() if k not in ('formats', 'http_headers', 'requested_subtitles')})
+        return None
+
+    ext = info.get("ext", "mp4" if is_video else "jpg")
+    if ext == "none":
+        ext = "jpg"
+    
+    # Force mp4 ext if the url is mp4 but metadata says otherwise
+    if is_video and ".mp4" in direct_url:
+         ext = "mp4"
+
+    media_type = "video" if is_video else "image"
+    title = info.get("title", "Media")
+    # Sanitize title
+    title = _sanitize_title(title)
+
+    # Ensure headers are populated
+    if not http_headers:
+        http_headers = {}
+    
+    # Force User-Agent if missing
+    if "User-Agent" not in http_headers:
+        http_headers["User-Agent"] = user_agent
+    
+    # Force Referer for TikTok if missing (often required)
+    if "tiktok.com" in url.lower() and "Referer" not in http_headers:
+        http_headers["Referer"] = "https://www.tiktok.com/"
+
+    logger.info(
+        "Extracted %s: title='%s', ext='%s'", media_type, title, ext
+    )
+
+    return {
+        "status": "success",
+        "title": title or "Media",
+        "direct_url": direct_url,
+        "media_urls": media_urls if 'media_urls' in locals() and media_urls else [direct_url],
+        "ext": ext,
+        "media_type": media_type,
+        "headers": http_headers,  # Pass headers to client
+        "_merge": _merge_plan(info) if is_video and not media_urls else None,
+        "_formats": compact if is_video and not media_urls else None,
+        "_media_id": f'{info.get("extractor_key")}:{info.get("id")}',
+    }
+
+
+# =====================
+# Fast-path Resolvers
+# =====================
+
+# Comma-separated resolver names to enable, "all" or "none"
+FAST_PATHS = os.getenv("FAST_PATHS", "all")
+FAST_PATH_TIMEOUT = float(os.getenv("FAST_PATH_TIMEOUT", "6"))
+# Overridable so the resolver can be pointed at a local stand-in (see bench/)
+TIKTOK_BASE_URL = os.getenv("TIKTOK_BASE_URL", "https://www.tiktok.com").rstrip("/")
+
+
+class FastPathRouter:
+    """
+    Ordered registry of single-request resolvers for the platforms that carry
+    most traffic. URLs are dispatched on their registered domain, then matched
+    against precompiled path patterns; yt-dlp is the fallback when none answers.
+    """
+
+    def __init__(self, enabled: str):
+        names = {name.strip() for name in enabled.split(",") if name.strip()}
+        self._enabled = None if names == {"all"} else names
+        self._routes: dict[str, list[tuple]] = {}
+        self._names: list[str] = []
+
+    def register(self, name: str, domains: tuple[str, ...], path_pattern: str):
+        """Decorator adding `resolver(ctx, match) -> dict | None`; earlier ones run first."""
+        pattern = re.compile(path_pattern)
+
+        def decorator(resolver):
+            if self._enabled is None or name in self._enabled:
+                self._names.append(name)
+                for domain in domains:
+                    self._routes.setdefault(domain, []).append((name, pattern, resolver))
+            return resolver
+        return decorator
+
+    def routes(self, url: str) -> list[tuple]:
+        """(name, resolver, match) for every resolver that accepts `url`, in order."""
+        parts = urllib.parse.urlsplit(url)
+        labels = (parts.hostname or "").lower().split(".")
+        for i in range(len(labels) - 1):
+            candidates = self._routes.get(".".join(labels[i:]))
+            if candidates:
+                return [
+                    (name, resolver, match)
+                    for name, pattern, resolver in candidates
+                    if (match := pattern.match(parts.path))
+                ]
+        return []
+
+    def enabled(self) -> list[str]:
+        return list(self._names)
+
+
+fast_paths = FastPathRouter(FAST_PATHS)
+
+
+def _run_fast_path(ctx: _ExtractionContext, name: str, resolver, match: re.Match) -> dict | None:
+    """One resolver attempt under the request deadline and its circuit breaker."""
+    if not ctx.deadline.allows(name):
+        return None
+    if not strategy_breakers.allow(ctx.platform, name):
+        _skip_stage(name, "breaker_open")
+        return None
+    with _stage(name) as stage:
+        miss = "rejected"
+        try:
+            result = resolver(ctx, match)
+        except Exception as e:
+            logger.warning("Fast path %s failed for %s: %s", name, ctx.url, e)
+            result = None
+            if _is_upstream_fault(e):
+                miss = "failure"
+        stage.outcome = "success" if result is not None else miss
+    strategy_breakers.record(ctx.platform, name, stage.outcome, stage.seconds)
+    if result is not None:
+        result["served_by"] = name
+    return result
+
+
+@fast_paths.register("instagram_post", ("instagram.com",), r"/(?:[^/]+/)?(?:p|reel|reels|tv)/([A-Za-z0-9_-]+)")
+def _fast_instagram_post(ctx: _ExtractionContext, match: re.Match) -> dict | None:
+    """Post, carousel or reel media from Instagram's JSON endpoint."""
+    api_url = f"{INSTAGRAM_BASE_URL}/p/{match.group(1)}/?__a=1&__d=dis"
+    ctx.fetched.add(api_url)  # The race's ig_api_dis candidate; don't ask twice
+    resp = _http_session().get(
+        api_url, headers=_INSTAGRAM_HEADERS, cookies=ctx.cookies,
+        timeout=ctx.deadline.budget("instagram_post", cap=FAST_PATH_TIMEOUT),
+    )
+    _raise_for_upstream(resp.status_code, api_url)
+    # Logged-out requests get the login page back instead of JSON
+    if resp.status_code != 200 or "json" not in resp.headers.get("Content-Type", ""):
+        return None
+    ig_result = _parse_instagram_json(resp.json())
+    return _instagram_response(ctx, ig_result) if ig_result else None
+
+
+_TIKTOK_STATE_RE = re.compile(
+    r'<script id="__UNIVERSAL_DATA_FOR_REHYDRATION__" type="application/json">(.*?)</script>', re.S
+)
+_TIKTOK_HEADERS = {
+    'User-Agent': _INSTAGRAM_HEADERS['User-Agent'],
+    'Referer': 'https://www.tiktok.com/',
+}
+
+
+@fast_paths.register("tiktok_web", ("tiktok.com",), r"/@[^/]+/(?:video|photo)/(\d+)")
+def _fast_tiktok_web(ctx: _ExtractionContext, match: re.Match) -> dict | None:
+    """Video (or photo-mode images) from the state embedded in the post page."""
+    resp = _http_session().get(
+        f"{TIKTOK_BASE_URL}{match.group(0)}", headers=_TIKTOK_HEADERS, cookies=ctx.cookies,
+        timeout=ctx.deadline.budget("tiktok_web", cap=FAST_PATH_TIMEOUT),
+    )
+    _raise_for_upstream(resp.status_code, resp.url)
+    if resp.status_code != 200:
+        return None
+    state = _TIKTOK_STATE_RE.search(resp.text)
+    if not state:
+        return None
+    detail = json.loads(state.group(1)).get("__DEFAULT_SCOPE__", {}).get("webapp.video-detail", {})
+    item = detail.get("itemInfo", {}).get("itemStruct")
+    if not item:
+        return None
+
+    images = (item.get("imagePost") or {}).get("images") or []
+    if images:
+        media_urls = [u for u in ((img.get("imageURL") or {}).get("urlList", [None])[0] for img in images) if u]
+        ext, media_type = "jpg", "image"
+    else:
+        video = item.get("video") or {}
+        play = video.get("playAddr") or video.get("downloadAddr")
+        media_urls = [play] if play else []
+        ext, media_type = "mp4", "video"
+    if not media_urls:
+        return None
+
+    # The CDN only serves media to the session (tt_chain_token) that loaded the page
+    cookie = "; ".join(f"{key}={value}" for key, value in resp.cookies.items())
+    return {
+        "status": "success",
+        "title": _sanitize_title(item.get("desc") or "") or "Media",
+        "direct_url": media_urls[0],
+        "media_urls": media_urls,
+        "ext": ext,
+        "media_type": media_type,
+        "headers": dict(_TIKTOK_HEADERS),
+        "_upstream_cookie": cookie or None,
+        "_media_id": f"TikTok:{item.get('id') or match.group(1)}",
+    }
+
+
+# =====================
+# Playlist Paging
+# =====================
+
+PLAYLIST_PAGE_SIZE = int(os.getenv("PLAYLIST_PAGE_SIZE", "10"))
+PLAYLIST_PAGE_MAX = int(os.getenv("PLAYLIST_PAGE_MAX", "50"))
+PLAYLIST_MAX_ENTRIES = int(os.getenv("PLAYLIST_MAX_ENTRIES", "1000"))
+PLAYLIST_CACHE_MAX_ENTRIES = int(os.getenv("PLAYLIST_CACHE_MAX_ENTRIES", "256"))
+PLAYLIST_CACHE_MAX_BYTES = int(os.getenv("PLAYLIST_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+playlist_cache = ExtractionCache(PLAYLIST_CACHE_MAX_ENTRIES, PLAYLIST_CACHE_MAX_BYTES, "playlist")
+
+
+def _encode_cursor(offset: int, limit: int) -> str:
+    raw = json.dumps({"offset": offset, "limit": limit}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _page_bounds(video_request: VideoRequest) -> tuple[int, int]:
+    """(offset, limit) from the request's cursor, or its offset/limit fields."""
+    offset, limit = video_request.offset, video_request.limit
+    if video_request.cursor:
+        try:
+            raw = video_request.cursor + "=" * (-len(video_request.cursor) % 4)
+            page = json.loads(base64.urlsafe_b64decode(raw))
+            offset, limit = int(page["offset"]), int(page["limit"])
+        except (ValueError, KeyError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+    # Each entry costs a rate-limit hit; a page must fit in one window
+    page_max = min(PLAYLIST_PAGE_MAX, _rate_limit_amount() or PLAYLIST_PAGE_MAX)
+    limit = min(max(limit or PLAYLIST_PAGE_SIZE, 1), page_max)
+    return max(offset, 0), limit
+
+
+def _list_playlist(url: str, request_cookies_b64: str | None,
+                   deadline: Deadline | None = None) -> dict:
+    """
+    Flat listing of a playlist/carousel. Entries that yt-dlp already returned
+    in full (e.g. carousel items) carry their built response; the rest only
+    their page URL, to be extracted when their page is requested.
+    """
+    deadline = deadline or Deadline(EXTRACT_DEADLINE_SECONDS)
+    if not deadline.allows("extract_listing"):
+        raise HTTPException(status_code=504, detail="Extraction deadline exceeded.")
+
+    with ydl_pool.checkout(_ydl_profile(url), _get_cookie_jar(request_cookies_b64)) as ydl:
+        with _stage("extract_listing") as stage, \
+                _override_params(ydl, extract_flat="in_playlist", noplaylist=False,
+                                 playlistend=PLAYLIST_MAX_ENTRIES), \
+                _socket_timeout(ydl, deadline.budget("extract_listing")):
+            try:
+                info = ydl.extract_info(url, download=False)
+            except yt_dlp.utils.DownloadError:
+                info = None
+            stage.ok = info is not None
+        if info is None:
+            raise HTTPException(
+                status_code=400,
+                detail="Could not extract info. The URL may be invalid or require login.",
+            )
+
+        entries = []
+        for entry in (info.get("entries") or ()) if "entries" in info else (info,):
+            if not entry:
+                continue
+            item = {
+                "id": entry.get("id"),
+                "title": entry.get("title"),
+                "url": entry.get("webpage_url") or entry.get("url") or url,
+            }
+            if entry.get("_type") not in ("url", "url_transparent"):
+                media = _build_response(url, entry, ydl.params.get("user_agent"))
+                if media is not None:
+                    media["_upstream_cookie"] = ydl.cookiejar.get_cookie_header(media["direct_url"])
+                    item["media"] = media
+            entries.append(item)
+
+    logger.info("Listed %d entries for %s", len(entries), url)
+    return {"title": _sanitize_title(info.get("title") or "") or "Playlist", "entries": entries}
+
+
+def _listing_ttl(listing: dict) -> float:
+    """Cache a listing only as long as the media URLs it already holds stay valid."""
+    ttls = [_result_ttl(e["media"]) for e in listing["entries"] if "media" in e]
+    return min(ttls, default=EXTRACT_CACHE_DEFAULT_TTL)
+
+
+async def _extract_page(video_request: VideoRequest, deadline_ms: int | None = None,
+                        progress=None) -> dict:
+    """
+    One page of a playlist/carousel. The flat listing is cached, so later
+    pages skip it; only the entries on this page are extracted, each through
+    the usual cache and single-flight.
+    """
+    report = progress or (lambda phase: None)
+    r = video_request
+    offset, limit = _page_bounds(r)
+    url = r.url.strip()
+    if not url.startswith("http"):
+        raise HTTPException(status_code=400, detail="Invalid URL. Must start with http(s).")
+
+    deadline = Deadline.for_request(deadline_ms)
+    report("resolving")
+    url = await run_in_threadpool(_resolve_short_link, url)
+    platform = _platform(url)
+    cache_key = _cache_key(url, r.cookies)
+
+    listing = playlist_cache.get(cache_key)
+    if listing is None:
+        report("listing")
+
+        async def list_and_cache() -> dict:
+            trace, stacks = [], {}
+            started = time.perf_counter()
+            try:
+                result = await extraction_pool.run(
+                    _list_playlist, url, r.cookies, deadline,
+                    trace=trace, deadline=deadline, stacks=stacks,
+                )
+            finally:
+                _record_trace(platform, trace)
+                slow_requests.consider(url, platform, time.perf_counter() - started, trace, stacks)
+            playlist_cache.put(cache_key, result, ttl=_listing_ttl(result))
+            return result
+
+        listing = await extraction_flight.do(("playlist",) + cache_key, list_and_cache)
+
+    entries = listing["entries"]
+    semaphore = asyncio.Semaphore(max(EXTRACT_BATCH_PARALLELISM, 1))
+
+    async def resolve(item: dict) -> dict:
+        line = {"id": item["id"], "title": item["title"], "url": item["url"]}
+        try:
+            async with semaphore:
+                if "media" in item:
+                    line.update(await _finalize_result(
+                        dict(item["media"]), r.cookies, platform, r.constraints, r.merge,
+                        lambda phase: None,
+                    ))
+                else:
+                    line.update(await _extract_shared(
+                        item["url"], r.cookies, deadline_ms, r.merge, r.constraints
+                    ))
+        except HTTPException as e:
+            line.update({"status": "error", "status_code": e.status_code, "detail": e.detail})
+        return line
+
+    report("extracting")
+    page = await asyncio.gather(*(resolve(item) for item in entries[offset:offset + limit]))
+    next_offset = offset + limit
+    return {
+        "status": "success",
+        "title": listing["title"],
+        "total": len(entries),
+        "offset": offset,
+        "limit": limit,
+        "entries": page,
+        "next_cursor": _encode_cursor(next_offset, limit) if next_offset < len(entries) else None,
+    }
+
+
+# =====================
+# Format Selection
+# =====================
+
+FORMAT_SHORTLIST_SIZE = int(os.getenv("FORMAT_SHORTLIST_SIZE", "5"))
+
+# Client codec names -> yt-dlp vcodec prefixes
+_CODEC_ALIASES = {
+    "h264": ("avc1", "avc", "h264"),
+    "avc": ("avc1", "avc", "h264"),
+    "h265": ("hvc1", "hev1", "hevc", "h265"),
+    "hevc": ("hvc1", "hev1", "hevc", "h265"),
+    "vp9": ("vp09", "vp9"),
+    "av1": ("av01", "av1"),
+}
+_DIRECT_PROTOCOLS = ("https", "http")
+
+
+def _compact_formats(info: dict) -> list[dict]:
+    """The downloadable formats of an info dict, trimmed to what selection needs."""
+    duration = info.get("duration")
+    compact = []
+    for f in info.get("formats") or ():
+        if not f.get("url") or f.get("ext") == "mhtml":  # Skip storyboards
+            continue
+        tbr = f.get("tbr")
+        size = f.get("filesize") or f.get("filesize_approx")
+        if not size and tbr and duration:
+            size = int(tbr * 1000 / 8 * duration)
+        compact.append({
+            "format_id": f.get("format_id"),
+            "url": f["url"],
+            "ext": f.get("ext"),
+            "protocol": f.get("protocol") or "https",
+            # Unknown codecs are treated as a single muxed file
+            "vcodec": f.get("vcodec") or "unknown",
+            "acodec": f.get("acodec") or "unknown",
+            "height": f.get("height"),
+            "width": f.get("width"),
+            "fps": f.get("fps"),
+            "tbr": tbr,
+            "filesize": size,
+            "headers": dict(f.get("http_headers") or {}),
+        })
+    return compact
+
+
+def _codec_rank(vcodec: str, preferred: list[str] | None) -> int:
+    if not preferred:
+        return 0
+    vcodec = vcodec.lower()
+    for i, name in enumerate(preferred):
+        name = name.lower()
+        if vcodec.startswith(_CODEC_ALIASES.get(name, (name,))):
+            return i
+    return len(preferred)
+
+
+def _container_rank(ext: str | None, preferred: list[str] | None) -> int:
+    if not preferred:
+        return 0
+    preferred = [p.lower().lstrip(".") for p in preferred]
+    return preferred.index(ext) if ext in preferred else len(preferred)
+
+
+def _fits(fmt: dict, constraints: FormatConstraints) -> bool:
+    c = constraints
+    if c.progressive_only and fmt["acodec"] == "none":
+        return False
+    if c.max_height and fmt["height"] and fmt["height"] > c.max_height:
+        return False
+    if c.max_filesize and fmt["filesize"] and fmt["filesize"] > c.max_filesize:
+        return False
+    if c.max_bitrate and fmt["tbr"] and fmt["tbr"] > c.max_bitrate:
+        return False
+    return True
+
+
+def _rank_formats(formats: list[dict], constraints: FormatConstraints) -> tuple[list[dict], bool]:
+    """
+    Rank video formats best first: directly downloadable, then height, codec
+    and container preference, audio included, bitrate. Returns the ranking
+    and whether it satisfies the constraints; if nothing does, the cheapest
+    formats come first instead.
+    """
+    fitting, rest = [], []
+    for fmt in formats:
+        if fmt["vcodec"] == "none":
+            continue
+        (fitting if _fits(fmt, constraints) else rest).append(fmt)
+    if not fitting:
+        return sorted(rest, key=lambda f: (f["height"] or 0, f["filesize"] or float("inf"))), False
+
+    def score(f: dict) -> tuple:
+        return (
+            f["protocol"] in _DIRECT_PROTOCOLS,
+            f["height"] or 0,
+            -_codec_rank(f["vcodec"], constraints.codecs),
+            -_container_rank(f["ext"], constraints.containers),
+            f["acodec"] != "none",
+            f["tbr"] or 0,
+        )
+
+    return sorted(fitting, key=score, reverse=True), True
+
+
+def _best_audio(formats: list[dict], video: dict, constraints: FormatConstraints) -> dict | None:
+    """Best audio-only format to pair with a video-only one, within the size budget."""
+    budget = None
+    if constraints.max_filesize and video["filesize"]:
+        budget = constraints.max_filesize - video["filesize"]
+    compatible = {"mp4": ("m4a", "mp4"), "webm": ("webm",)}.get(video["ext"], ())
+    candidates = [
+        f for f in formats
+        if f["vcodec"] == "none" and f["acodec"] != "none"
+        and (budget is None or not f["filesize"] or f["filesize"] <= budget)
+    ]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda f: (
+        f["protocol"] in _DIRECT_PROTOCOLS, f["ext"] in compatible, f["tbr"] or 0,
+    ))
+
+
+def _public_format(fmt: dict) -> dict:
+    keys = ("format_id", "url", "ext", "vcodec", "acodec", "height", "width", "fps", "tbr", "filesize")
+    return {**{k: fmt[k] for k in keys}, "progressive": fmt["acodec"] != "none"}
+
+
+def _apply_format_selection(result: dict, constraints: FormatConstraints) -> None:
+    """
+    Re-point a video result at the best format for the client's constraints
+    and add a ranked shortlist. Split formats come with the best matching
+    audio_url, and merge mode muxes that pair.
+    """
+    formats = result.get("_formats")
+    if not formats:
+        return
+    ranked, met = _rank_formats(formats, constraints)
+    if not ranked:
+        return
+
+    best = ranked[0]
+    audio = _best_audio(formats, best, constraints) if best["acodec"] == "none" else None
+    result.update({
+        "direct_url": best["url"],
+        "media_urls": [best["url"]],
+        "ext": best["ext"],
+        "headers": {**(result.get("headers") or {}), **best["headers"]},
+        "audio_url": audio["url"] if audio else None,
+        "format": {**_public_format(best), "constraints_met": met},
+        "formats": [_public_format(f) for f in ranked[:FORMAT_SHORTLIST_SIZE]],
+        "_upstream_cookie": best.get("cookie"),
+        "_merge": _pair_plan(result["_media_id"], best, audio) if audio else None,
+    })
+
+
+# =====================
+# Media Streaming Proxy
+# =====================
+
+STREAM_TOKEN_TTL = float(os.getenv("STREAM_TOKEN_TTL", "3600"))
+STREAM_TOKEN_MAX_ENTRIES = int(os.getenv("STREAM_TOKEN_MAX_ENTRIES", "10000"))
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(64 * 1024)))
+STREAM_UPSTREAM_TIMEOUT = float(os.getenv("STREAM_UPSTREAM_TIMEOUT", "30"))
+STREAM_MAX_CONCURRENT = int(os.getenv("STREAM_MAX_CONCURRENT", "16"))
+STREAM_MAX_PER_CLIENT = int(os.getenv("STREAM_MAX_PER_CLIENT", "4"))
+# Bytes per second; 0 disables the cap
+STREAM_RATE_PER_STREAM = int(os.getenv("STREAM_RATE_PER_STREAM", "0"))
+STREAM_RATE_GLOBAL = int(os.getenv("STREAM_RATE_GLOBAL", "0"))
+
+# Redirect hops followed (and re-checked) per upstream request
+STREAM_MAX_REDIRECTS = int(os.getenv("STREAM_MAX_REDIRECTS", "5"))
+# Media URLs on loopback/private/link-local addresses are refused unless this is
+# set (e.g. to point at a local stand-in CDN)
+MEDIA_ALLOW_PRIVATE_HOSTS = os.getenv("MEDIA_ALLOW_PRIVATE_HOSTS", "0") == "1"
+
+# Request/response headers relayed between the client and the upstream CDN
+_STREAM_REQUEST_HEADERS = ("Range", "If-Range")
+_STREAM_RESPONSE_HEADERS = (
+    "Content-Type", "Content-Length", "Content-Range", "Accept-Ranges",
+    "ETag", "Last-Modified", "Cache-Control",
+)
+
+# Same secret on every worker, so equal results carry equal tokens (and ETags)
+STREAM_TOKEN_SECRET = os.getenv("STREAM_TOKEN_SECRET", "")
+
+
+def _load_stream_secret() -> bytes:
+    """STREAM_TOKEN_SECRET, else one agreed through the shared state backend, else per process."""
+    if STREAM_TOKEN_SECRET:
+        return STREAM_TOKEN_SECRET.encode()
+    if state_backend is not None:
+        try:
+            return state_backend.set_default("stream:secret", secrets.token_hex(16), 10 * 365 * 86400).encode()
+        except _STATE_ERRORS as e:
+            logger.warning("Shared stream secret unavailable, tokens will differ per worker: %s", e)
+    return os.urandom(16)
+
+
+_stream_secret = _load_stream_secret()
+# Blocking upstream reads run here so long downloads never occupy the shared threadpool
+_stream_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=max(STREAM_MAX_CONCURRENT, 1), thread_name_prefix="stream"
+)
+
+
+class StreamTokens:
+    """
+    Server-side registry of media URLs, upstream headers and cookies behind
+    opaque /stream tokens. Tokens are derived from their content, so repeated
+    (or cached) extractions of the same media reuse one entry. With a shared
+    state backend, tokens resolve on every worker.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def issue(self, url: str, headers: dict, request_cookies_b64: str | None) -> str:
+        entry = {"url": url, "headers": headers, "cookies": request_cookies_b64}
+        digest = hashlib.sha256(_stream_secret)
+        digest.update(json.dumps(entry, sort_keys=True, default=str).encode())
+        token = digest.hexdigest()[:32]
+
+        expiry = _url_expiry(url)
+        ttl = STREAM_TOKEN_TTL if expiry is None else min(expiry - time.time(), STREAM_TOKEN_TTL)
+        self._store(token, entry, time.time() + ttl)
+        if state_backend is not None and ttl > 0:
+            try:
+                state_backend.set("stream:" + token, json.dumps(entry), ttl)
+            except _STATE_ERRORS as e:
+                logger.warning("Shared stream token write failed: %s", e)
+        return token
+
+    def _store(self, token: str, entry: dict, expires_at: float) -> None:
+        with self._lock:
+            self._entries[token] = (expires_at, entry)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def resolve(self, token: str) -> dict | None:
+        with self._lock:
+            item = self._entries.get(token)
+            if item is not None and item[0] > time.time():
+                self._entries.move_to_end(token)
+                return item[1]
+            self._entries.pop(token, None)
+        if state_backend is None:
+            return None
+        try:
+            raw = state_backend.get("stream:" + token)
+            expires_at = state_backend.expires_at("stream:" + token) if raw else None
+        except _STATE_ERRORS as e:
+            logger.warning("Shared stream token read failed: %s", e)
+            return None
+        if raw is None or expires_at is None:
+            return None
+        entry = json.loads(raw)
+        self._store(token, entry, expires_at)
+        return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tokens": len(self._entries)}
+
+
+stream_tokens = StreamTokens(STREAM_TOKEN_MAX_ENTRIES)
+
+
+def _attach_stream_urls(result: dict, request_cookies_b64: str | None) -> dict:
+    """Register the result's media URLs and add /stream links for them."""
+    headers = dict(result.get("headers") or {})
+    upstream_cookie = result.get("_upstream_cookie")
+    for key in [k for k in result if k.startswith("_")]:
+        del result[key]  # Server-side only
+    if upstream_cookie:
+        headers["Cookie"] = upstream_cookie
+    # yt-dlp's cookie header already includes the caller's cookies
+    cookies = None if upstream_cookie else request_cookies_b64
+
+    def link(media_url: str) -> str:
+        return "/stream/" + stream_tokens.issue(media_url, headers, cookies)
+
+    result["stream_url"] = link(result["direct_url"])
+    result["stream_urls"] = [link(u) for u in result.get("media_urls") or []]
+    return result
+
+
+class _Throttle:
+    """Paces byte transfers to `rate` bytes per second (0 = unlimited)."""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._next = 0.0
+
+    async def consume(self, size: int) -> None:
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        start = max(now, self._next)
+        self._next = start + size / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class StreamSlots:
+    """Global and per-client caps on concurrent proxied streams."""
+
+    def __init__(self, max_total: int, max_per_client: int):
+        self.max_total = max_total
+        self.max_per_client = max_per_client
+        self.active = 0
+        self.rejected = 0
+        self.bytes_sent = 0
+        self._per_client: dict[str, int] = {}
+
+    def acquire(self, client: str) -> None:
+        if self.active >= self.max_total:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Too many active streams. Try again shortly.",
+                headers={"Retry-After": "5"},
+            )
+        if self._per_client.get(client, 0) >= self.max_per_client:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many concurrent streams (max {self.max_per_client} per client).",
+                headers={"Retry-After": "5"},
+            )
+        self.active += 1
+        self._per_client[client] = self._per_client.get(client, 0) + 1
+
+    def release(self, client: str) -> None:
+        self.active -= 1
+        remaining = self._per_client.get(client, 1) - 1
+        if remaining:
+            self._per_client[client] = remaining
+        else:
+            self._per_client.pop(client, None)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "rejected": self.rejected,
+            "bytes_sent": self.bytes_sent,
+            "tokens": stream_tokens.stats()["tokens"],
+        }
+
+
+stream_slots = StreamSlots(STREAM_MAX_CONCURRENT, STREAM_MAX_PER_CLIENT)
+_stream_global_throttle = _Throttle(STREAM_RATE_GLOBAL)
+
+
+class _ProxyResponse(StreamingResponse):
+    """StreamingResponse that always runs `on_close`, even if the client leaves before the body starts."""
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self._on_close()
+
+
+class BlockedUpstream(ValueError):
+    """A media URL points at a host the server must not fetch from."""
+
+
+def _check_media_url(url: str) -> None:
+    """
+    Refuse media URLs that are not http(s) or whose host resolves to a
+    loopback, private, link-local (cloud metadata) or otherwise non-public
+    address. Extracted pages choose these URLs, so they are untrusted.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise BlockedUpstream(f"unsupported media URL: {url[:100]}")
+    if MEDIA_ALLOW_PRIVATE_HOSTS:
+        return
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    for *_, sockaddr in socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP):
+        address = ipaddress.ip_address(sockaddr[0].split("%", 1)[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise BlockedUpstream(f"{parts.hostname} resolves to non-public address {address}")
+
+
+def _open_upstream(entry: dict, client_headers: dict):
+    """GET the media, following redirects by hand so every hop is checked."""
+    headers = {**entry["headers"], **client_headers}
+    cookies = None if "Cookie" in headers else _get_cookie_jar(entry["cookies"])
+    url = entry["url"]
+    for _ in range(STREAM_MAX_REDIRECTS + 1):
+        _check_media_url(url)
+        resp = _http_session().get(
+            url, headers=headers, cookies=cookies,
+            timeout=STREAM_UPSTREAM_TIMEOUT, stream=True, allow_redirects=False,
+        )
+        location = resp.headers.get("Location")
+        if resp.status_code not in (301, 302, 303, 307, 308) or not location:
+            return resp
+        resp.close()
+        url = urllib.parse.urljoin(url, location)
+    raise BlockedUpstream(f"more than {STREAM_MAX_REDIRECTS} redirects")
+
+
+@app.get("/stream/{token}")
+async def stream_media(token: str, request: Request):
+    """
+    Proxy the media behind a token issued by /extract. Range requests are
+    passed through, so clients can seek and resume.
+    """
+    entry = stream_tokens.resolve(token)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired stream token.")
+
+    client = get_remote_address(request)
+    stream_slots.acquire(client)
+    loop = asyncio.get_running_loop()
+    client_headers = {h: request.headers[h] for h in _STREAM_REQUEST_HEADERS if h in request.headers}
+    try:
+        upstream = await loop.run_in_executor(_stream_executor, _open_upstream, entry, client_headers)
+    except BlockedUpstream as e:
+        stream_slots.release(client)
+        logger.warning("Stream upstream refused for %s: %s", _platform(entry["url"]), e)
+        raise HTTPException(status_code=403, detail="Upstream media host is not allowed.")
+    except Exception as e:
+        stream_slots.release(client)
+        logger.warning("Stream upstream failed for %s: %s", _platform(entry["url"]), e)
+        raise HTTPException(status_code=502, detail="Upstream media request failed.")
+
+    if upstream.status_code >= 400 and upstream.status_code != 416:
+        await loop.run_in_executor(_stream_executor, upstream.close)
+        stream_slots.release(client)
+        raise HTTPException(status_code=502, detail=f"Upstream returned {upstream.status_code}.")
+
+    headers = {h: upstream.headers[h] for h in _STREAM_RESPONSE_HEADERS if h in upstream.headers}
+    platform = _platform(entry["url"])
+
+    async def body():
+        chunks = upstream.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+        throttle = _Throttle(STREAM_RATE_PER_STREAM)
+        while True:
+            chunk = await loop.run_in_executor(_stream_executor, next, chunks, None)
+            if chunk is None:
+                break
+            await throttle.consume(len(chunk))
+            await _stream_global_throttle.consume(len(chunk))
+            stream_slots.bytes_sent += len(chunk)
+            metrics.inc("video_downloader_stream_bytes_total", len(chunk), platform=platform)
+            yield chunk
+
+    async def close():
+        stream_slots.release(client)
+        await loop.run_in_executor(_stream_executor, upstream.close)
+
+    return _ProxyResponse(body(), close, status_code=upstream.status_code, headers=headers)
+
+
+# =====================
+# Server-side Merge & Artifact Cache
+# =====================
+
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "downloads")
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+MERGE_CACHE_MAX_BYTES = int(os.getenv("MERGE_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+MERGE_MAX_BYTES = int(os.getenv("MERGE_MAX_BYTES", str(512 * 1024 ** 2)))
+MERGE_MAX_CONCURRENT = int(os.getenv("MERGE_MAX_CONCURRENT", "2"))
+MERGE_TIMEOUT = float(os.getenv("MERGE_TIMEOUT", "300"))
+
+_ARTIFACT_NAME = re.compile(r"[0-9a-f]{32}\.(mp4|webm|mkv)")
+_MERGE_FORMATS = {"mp4": "mp4", "webm": "webm", "mkv": "matroska"}
+
+
+def _merge_plan(info: dict) -> dict | None:
+    """The video-only + audio-only pair yt-dlp selected, if the best format is split."""
+    requested = _compact_formats({"formats": info.get("requested_formats"), "duration": info.get("duration")})
+    video = next((f for f in requested if f["vcodec"] != "none"), None)
+    audio = next((f for f in requested if f["vcodec"] == "none" and f["acodec"] != "none"), None)
+    if not video or not audio:
+        return None
+    return _pair_plan(f'{info.get("extractor_key")}:{info.get("id")}', video, audio)
+
+
+def _pair_plan(media_id: str, video: dict, audio: dict) -> dict:
+    """
+    Merge plan for a compact video/audio pair. The artifact name is derived
+    from the media and format IDs rather than the (signed, expiring) URLs,
+    so every extraction of the same pair maps to one file.
+    """
+    exts = {video["ext"], audio["ext"]}
+    if exts <= {"mp4", "m4a"}:
+        ext = "mp4"
+    elif exts == {"webm"}:
+        ext = "webm"
+    else:
+        ext = "mkv"
+    identity = f'{media_id}:{video["format_id"]}+{audio["format_id"]}'
+    sizes = [video["filesize"], audio["filesize"]]
+    sources = []
+    for fmt in (video, audio):
+        headers = dict(fmt["headers"])
+        if fmt.get("cookie"):
+            headers["Cookie"] = fmt["cookie"]
+        sources.append({"url": fmt["url"], "headers": headers})
+    return {
+        "name": f"{hashlib.sha256(identity.encode()).hexdigest()[:32]}.{ext}",
+        "size": sum(sizes) if all(sizes) else None,
+        "sources": sources,
+    }
+
+
+class ArtifactCache:
+    """
+    Merged files under DOWNLOAD_DIR, evicted least-recently-used once their
+    total size exceeds `max_bytes`. Only touched from the event loop.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._files: OrderedDict[str, int] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._scan()
+
+    def _scan(self) -> None:
+        """
+        Index files left by a previous run, oldest first. Unfinished merges are
+        dropped only once stale: other workers may still be writing theirs.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        found = []
+        stale_before = time.time() - MERGE_TIMEOUT - 60
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".part"):
+                with contextlib.suppress(FileNotFoundError):
+                    if entry.stat().st_mtime < stale_before:
+                        os.remove(entry.path)
+            elif _ARTIFACT_NAME.fullmatch(entry.name):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._files[name] = size
+            self._bytes += size
+        self._evict()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def get(self, name: str) -> str | None:
+        """Path of a cached artifact, marking it recently used."""
+        if not os.path.exists(self.path(name)):
+            self._bytes -= self._files.pop(name, 0)
+            self.misses += 1
+            return None
+        if name not in self._files:  # Merged by another worker
+            self._files[name] = os.path.getsize(self.path(name))
+            self._bytes += self._files[name]
+        self._files.move_to_end(name)
+        os.utime(self.path(name))  # Keeps LRU order across restarts
+        self.hits += 1
+        return self.path(name)
+
+    def add(self, name: str) -> None:
+        size = os.path.getsize(self.path(name))
+        self._bytes += size - self._files.pop(name, 0)
+        self._files[name] = size
+        self._evict(keep=name)
+
+    def _evict(self, keep: str | None = None) -> None:
+        while self._bytes > self.max_bytes and self._files:
+            oldest = next(iter(self._files))
+            if oldest == keep:
+                break
+            self._bytes -= self._files.pop(oldest)
+            self.evictions += 1
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(oldest))
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._files),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+artifact_cache = ArtifactCache(DOWNLOAD_DIR, MERGE_CACHE_MAX_BYTES)
+merge_flight = SingleFlight(EXTRACT_SINGLEFLIGHT_MAX_WAITERS)
+_merge_semaphore = asyncio.Semaphore(max(MERGE_MAX_CONCURRENT, 1))
+
+
+async def _run_merge(plan: dict, platform: str) -> None:
+    """Remux the pair with ffmpeg stream copy into the artifact cache."""
+    name = plan["name"]
+    ext = name.rsplit(".", 1)[1]
+    os.makedirs(artifact_cache.directory, exist_ok=True)
+    # Per-process name, so workers merging the same pair never share a file
+    part = f"{artifact_cache.path(name)}.{os.getpid()}.part"
+
+    for source in plan["sources"]:
+        try:
+            await run_in_threadpool(_check_media_url, source["url"])
+        except BlockedUpstream as e:
+            logger.warning("Merge source refused for %s: %s", name, e)
+            raise HTTPException(status_code=403, detail="Upstream media host is not allowed.")
+        except OSError as e:
+            logger.warning("Merge source lookup failed for %s: %s", name, e)
+            raise HTTPException(status_code=502, detail="Upstream media request failed.")
+
+    cmd = [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-nostdin", "-y"]
+    for source in plan["sources"]:
+        if source["headers"]:
+            cmd += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in source["headers"].items())]
+        cmd += ["-protocol_whitelist", "https,tls,tcp", "-i", source["url"]]
+    cmd += ["-map", "0:v:0", "-map", "1:a:0", "-c", "copy", "-fs", str(MERGE_MAX_BYTES)]
+    if ext == "mp4":
+        cmd += ["-movflags", "+faststart"]
+    cmd += ["-f", _MERGE_FORMATS[ext], part]
+
+    records = []
+    async with _merge_semaphore:
+        with _stage("merge", records) as stage:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+                )
+            except FileNotFoundError:
+                logger.error("ffmpeg not found at %r; server-side merging is disabled", FFMPEG_BIN)
+                raise HTTPException(status_code=501, detail="Server-side merging is not available.")
+            try:
+                _, stderr = await asyncio.wait_for(proc.communicate(), MERGE_TIMEOUT)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                stage.outcome = "timeout"
+            except BaseException:
+                proc.kill()
+                raise
+            else:
+                stage.ok = proc.returncode == 0
+
+    _record_trace(platform, records)
+    if not stage.ok:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(part)
+        if stage.outcome == "timeout":
+            raise HTTPException(status_code=504, detail="Merging timed out.")
+        logger.error("ffmpeg merge failed for %s: %s", name, stderr.decode(errors="replace")[-500:])
+        raise HTTPException(status_code=502, detail="Merging video and audio failed.")
+
+    if os.path.getsize(part) >= MERGE_MAX_BYTES:  # Cut short by -fs
+        os.remove(part)
+        raise HTTPException(
+            status_code=413,
+            detail=f"Media too large to merge (max {MERGE_MAX_BYTES // 1024 ** 2} MB).",
+        )
+    os.replace(part, artifact_cache.path(name))
+    artifact_cache.add(name)
+    logger.info("Merged %s in %.1fs", name, stage.seconds)
+
+
+async def _attach_merged_file(result: dict, platform: str) -> None:
+    """Ensure the result's video+audio pair is muxed on disk and add merged_url."""
+    plan = result.get("_merge")
+    if not plan:
+        result["merged_url"] = None  # Already a single progressive file (or an image)
+        return
+    if plan["size"] and plan["size"] > MERGE_MAX_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Media too large to merge (max {MERGE_MAX_BYTES // 1024 ** 2} MB).",
+        )
+    if artifact_cache.get(plan["name"]) is None:
+        await merge_flight.do(plan["name"], lambda: _run_merge(plan, platform))
+    result["merged_url"] = "/files/" + plan["name"]
+
+
+# =====================
+# Async Jobs
+# =====================
+
+JOB_STORE_MAX_JOBS = int(os.getenv("JOB_STORE_MAX_JOBS", "1000"))
+JOB_STORE_MAX_BYTES = int(os.getenv("JOB_STORE_MAX_BYTES", str(32 * 1024 * 1024)))
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "600"))
+JOB_EVENTS_KEEPALIVE = float(os.getenv("JOB_EVENTS_KEEPALIVE", "15"))
+# How often SSE polls the shared state backend for a job running on another worker
+JOB_REMOTE_POLL_SECONDS = float(os.getenv("JOB_REMOTE_POLL_SECONDS", "0.5"))
+
+
+class Job:
+    """One background extraction and the events it has emitted so far."""
+
+    def __init__(self, key: tuple):
+        self.id = secrets.token_urlsafe(12)
+        self.key = key
+        self.status = "queued"  # queued | running | succeeded | failed
+        self.phase = "queued"
+        self.created_at = time.time()
+        self.finished_at: float | None = None
+        self.events: list[dict] = []
+        self.result: dict | None = None
+        self.error: dict | None = None
+        self.size = 0
+        self.task: asyncio.Task | None = None
+        self.remote = False  # Read-only copy of a job owned by another worker
+        self._changed = asyncio.Event()
+
+    @classmethod
+    def from_shared(cls, job_id: str, state: dict) -> "Job":
+        job = cls(())
+        job.id = job_id
+        job.remote = True
+        job.status, job.phase = state["status"], state["phase"]
+        job.events, job.result, job.error = state["events"], state["result"], state["error"]
+        return job
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def emit(self, event: str, data: dict) -> None:
+        self.events.append({"id": len(self.events), "event": event, "data": data})
+        self.size += len(json.dumps(data, default=str))
+        # Wake every listener, then start a fresh event for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+        self.publish()
+
+    def publish(self) -> None:
+        """Mirror the job to the shared state backend, if any, for other workers."""
+        if state_backend is not None:
+            state = {
+                "status": self.status, "phase": self.phase, "events": self.events,
+                "result": self.result, "error": self.error,
+            }
+            try:
+                state_backend.set("job:" + self.id, json.dumps(state, default=str), JOB_RESULT_TTL)
+            except _STATE_ERRORS as e:
+                logger.warning("Shared job write failed: %s", e)
+
+    def advance(self, phase: str) -> None:
+        self.status = "running"
+        self.phase = phase
+        self.emit("stage", {"phase": phase, "elapsed_ms": round((time.time() - self.created_at) * 1000)})
+
+    def finish(self, result: dict | None = None, error: dict | None = None) -> None:
+        self.status = "failed" if error else "succeeded"
+        self.phase = self.status
+        self.result, self.error = result, error
+        self.finished_at = time.time()
+        self.emit("error" if error else "result", error or result)
+
+    async def wait(self, timeout: float) -> None:
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._changed.wait(), timeout)
+
+    def snapshot(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "phase": self.phase,
+            "stages": [e["data"] for e in self.events if e["event"] == "stage"],
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobStore:
+    """
+    Jobs by id, bounded by count and by the size of their events and
+    results. Finished jobs expire after `ttl` and are evicted oldest first
+    when over a cap; running jobs are never evicted. Identical requests
+    that are pending or succeeded reuse the same job.
+    """
+
+    def __init__(self, max_jobs: int, max_bytes: int, ttl: float):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._by_key: dict[tuple, str] = {}
+        self.created = 0
+        self.reused = 0
+        self.evictions = 0
+
+    def get(self, job_id: str) -> Job | None:
+        self._prune()
+        job = self._jobs.get(job_id)
+        if job is None and state_backend is not None and job_id:
+            try:
+                raw = state_backend.get("job:" + job_id)
+            except _STATE_ERRORS as e:
+                logger.warning("Shared job read failed: %s", e)
+                raw = None
+            if raw is not None:
+                job = Job.from_shared(job_id, json.loads(raw))
+        return job
+
+    def find(self, key: tuple) -> Job | None:
+        self._prune()
+        job = self._jobs.get(self._by_key.get(key, ""))
+        if job is not None and job.status != "failed":
+            self.reused += 1
+            return job
+        return None
+
+    def add(self, key: tuple) -> Job:
+        self._prune(room_for=1)
+        if len(self._jobs) >= self.max_jobs:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many jobs in progress. Retry shortly.",
+                headers={"Retry-After": "5"},
+            )
+        job = Job(key)
+        self._jobs[job.id] = job
+        self._by_key[key] = job.id
+        self.created += 1
+        job.publish()
+        return job
+
+    def _drop(self, job_id: str) -> None:
+        job = self._jobs.pop(job_id)
+        if self._by_key.get(job.key) == job_id:
+            del self._by_key[job.key]
+
+    def _prune(self, room_for: int = 0) -> None:
+        now = time.time()
+        finished = []
+        for job in list(self._jobs.values()):  # Oldest first
+            if not job.done:
+                continue
+            if now - job.finished_at > self.ttl:
+                self._drop(job.id)
+            else:
+                finished.append(job)
+        total = sum(j.size for j in self._jobs.values())
+        while finished and (total > self.max_bytes or len(self._jobs) + room_for > self.max_jobs):
+            job = finished.pop(0)
+            total -= job.size
+            self._drop(job.id)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "jobs": len(self._jobs),
+            "running": sum(not j.done for j in self._jobs.values()),
+            "bytes": sum(j.size for j in self._jobs.values()),
+            "created": self.created,
+            "reused": self.reused,
+            "evictions": self.evictions,
+        }
+
+
+job_store = JobStore(JOB_STORE_MAX_JOBS, JOB_STORE_MAX_BYTES, JOB_RESULT_TTL)
+
+
+async def _run_job(job: Job, video_request: VideoRequest) -> None:
+    try:
+        result = await _extract_request(video_request, video_request.deadline_ms, job.advance)
+    except HTTPException as e:
+        job.finish(error={"status_code": e.status_code, "detail": e.detail})
+    except Exception as e:
+        logger.error("Job %s failed: %s", job.id, e)
+        job.finish(error={"status_code": 500, "detail": str(e)})
+    else:
+        job.finish(result=result)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(video_request: VideoRequest, request: Request):
+    """
+    Start an extraction in the background and return its job id at once.
+    Resubmitting a request that is pending or done returns the same job
+    and costs neither rate limit nor extraction work.
+    """
+    key = _request_key(video_request)
+    job = job_store.find(key)
+    if job is None:
+        _charge_rate_limit(request, _request_cost(video_request))
+        job = job_store.add(key)
+        job.task = asyncio.ensure_future(_run_job(job, video_request))
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events",
+    }
+
+
+def _get_job(job_id: str) -> Job:
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job.")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return _get_job(job_id).snapshot()
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """
+    Server-sent events: one `stage` event per phase, then a final `result`
+    or `error`. Reconnecting with Last-Event-ID resumes after that event.
+    """
+    job = _get_job(job_id)
+    try:
+        cursor = int(request.headers.get("Last-Event-ID", "-1")) + 1
+    except ValueError:
+        cursor = 0
+
+    async def stream():
+        nonlocal cursor, job
+        last_write = time.monotonic()
+        while True:
+            # Re-read the list after every yield: events keep arriving while we're paused
+            while cursor < len(job.events):
+                event = job.events[cursor]
+                data = json.dumps(event["data"], default=str)
+                yield f'id: {event["id"]}\nevent: {event["event"]}\ndata: {data}\n\n'
+                cursor = event["id"] + 1
+                last_write = time.monotonic()
+            if job.done or await request.is_disconnected():
+                return
+            if job.remote:
+                await asyncio.sleep(JOB_REMOTE_POLL_SECONDS)
+                job = job_store.get(job_id) or job
+            elif len(job.events) <= cursor:
+                await job.wait(JOB_EVENTS_KEEPALIVE)
+            if len(job.events) <= cursor and time.monotonic() - last_write >= JOB_EVENTS_KEEPALIVE:
+                yield ": keep-alive\n\n"
+                last_write = time.monotonic()
+
+    return StreamingResponse(
+        stream(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# =====================
+# Profiling
+# =====================
+
+# Bearer token for the /admin endpoints; unset, they answer 404
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# Keep a profile of extractions slower than this; 0 turns the per-request sampler off
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "0"))
+SLOW_REQUEST_SAMPLE_INTERVAL = float(os.getenv("SLOW_REQUEST_SAMPLE_INTERVAL", "0.01"))
+SLOW_REQUEST_BUFFER = int(os.getenv("SLOW_REQUEST_BUFFER", "20"))
+
+# Leaf frames of threads parked with nothing to do
+_IDLE_FRAMES = {
+    ("threading.py", "wait"), ("queue.py", "get"), ("selectors.py", "select"),
+    ("thread.py", "_worker"), ("connection.py", "wait"),
+}
+
+
+def _collapse_stack(frame) -> str:
+    """Root-first `function (file:line)` frames joined by ';', as flamegraph tools expect."""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+def _is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_FRAMES
+
+
+def _render_collapsed(stacks: dict) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+def _sample_process(seconds: float, interval: float, include_idle: bool) -> dict:
+    """Sample every thread of this process for `seconds`; stacks are rooted at the thread name."""
+    stacks: dict[str, int] = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        skip = {threading.get_ident(), request_sampler.ident}
+        names = {t.ident: re.sub(r"_\d+$", "", t.name) for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident in skip or (not include_idle and _is_idle(frame)):
+                continue
+            stack = f"{names.get(ident, 'thread')};{_collapse_stack(frame)}"
+            stacks[stack] = stacks.get(stack, 0) + 1
+        time.sleep(interval)
+    return stacks
+
+
+class RequestSampler:
+    """
+    Samples the stacks of threads that registered with `begin()` until they
+    call `end()`. Its thread only starts on first use, so with slow-request
+    capture off there is no sampling at all.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._active: dict[int, dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def begin(self) -> None:
+        with self._lock:
+            self._active[threading.get_ident()] = {}
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-sampler", daemon=True)
+                self._thread.start()
+
+    def end(self) -> dict[str, int]:
+        with self._lock:
+            return self._active.pop(threading.get_ident(), {})
+
+    @property
+    def ident(self) -> int | None:
+        return self._thread.ident if self._thread is not None else None
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for ident, stacks in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = _collapse_stack(frame)
+                        stacks[stack] = stacks.get(stack, 0) + 1
+
+
+class SlowRequestLog:
+    """Ring buffer of stack profiles from extractions over SLOW_REQUEST_SECONDS."""
+
+    def __init__(self, threshold: float, size: int):
+        self.threshold = threshold
+        self._entries: deque[dict] = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.captured = 0
+
+    def consider(self, url: str, platform: str, seconds: float, trace: list, stacks: dict) -> None:
+        if self.threshold <= 0 or seconds < self.threshold:
+            return
+        entry = {
+            "id": secrets.token_urlsafe(8),
+            "at": time.time(),
+            "url": url,
+            "platform": platform,
+            "seconds": round(seconds, 3),
+            "stages": _stage_report(trace),
+            "samples": sum(stacks.values()),
+            "stacks": dict(stacks),
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self.captured += 1
+        logger.warning("Slow extraction (%.1fs) captured as %s: %s", seconds, entry["id"], url)
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            return [{k: v for k, v in e.items() if k != "stacks"} for e in reversed(self._entries)]
+
+    def get(self, capture_id: str) -> dict | None:
+        with self._lock:
+            return next((e for e in self._entries if e["id"] == capture_id), None)
+
+
+request_sampler = RequestSampler(SLOW_REQUEST_SAMPLE_INTERVAL)
+slow_requests = SlowRequestLog(SLOW_REQUEST_SECONDS, SLOW_REQUEST_BUFFER)
+_profile_lock = asyncio.Lock()
+
+
+def _require_admin(request: Request) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    supplied = request.headers.get("Authorization", "")
+    scheme, _, token = supplied.partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token.", headers={"WWW-Authenticate": "Bearer"})
+
+
+def _collapsed_response(stacks: dict, filename: str) -> PlainTextResponse:
+    return PlainTextResponse(
+        _render_collapsed(stacks),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.post("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10.0, idle: bool = False):
+    """
+    Sample this worker's threads for `seconds` and return collapsed stacks
+    (flamegraph.pl / speedscope input). With EXTRACT_EXECUTOR=process the
+    extraction work runs in child processes; use slow-request capture there.
+    """
+    _require_admin(request)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}].")
+    if _profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running.")
+    async with _profile_lock:
+        stacks = await run_in_threadpool(_sample_process, seconds, PROFILE_SAMPLE_INTERVAL, idle)
+    return _collapsed_response(stacks, f"profile-{os.getpid()}-{int(time.time())}.collapsed")
+
+
+@app.get("/admin/slow-requests")
+def admin_slow_requests(request: Request):
+    """Captured slow extractions, newest first, without their stacks."""
+    _require_admin(request)
+    return {
+        "threshold_seconds": SLOW_REQUEST_SECONDS,
+        "captured": slow_requests.captured,
+        "entries": slow_requests.list(),
+    }
+
+
+@app.get("/admin/slow-requests/{capture_id}")
+def admin_slow_request(capture_id: str, request: Request):
+    """Collapsed stacks of one captured slow extraction."""
+    _require_admin(request)
+    entry = slow_requests.get(capture_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Capture not found.")
+    return _collapsed_response(entry["stacks"], f"slow-{entry['platform']}-{capture_id}.collapsed")
+
+
+# =====================
+# Legacy File Serving (backward compat)
+# =====================
+
+@app.get("/files/{name}")
+async def serve_file(name: str):
+    """Serve a merged artifact. Range requests are supported."""
+    path = artifact_cache.get(name) if _ARTIFACT_NAME.fullmatch(name) else None
+    if path is None:
+        raise HTTPException(status_code=404, detail="File not found or expired.")
+    return FileResponse(path, media_type=mimetypes.guess_type(name)[0] or "application/octet-stream")
+
+
+
 
+startup["import_seconds"] = time.perf_counter() - _IMPORT_STARTED
 
 
 # =====================
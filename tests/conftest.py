@@ -0,0 +1,83 @@
+"""
+Shared fixtures: the bench's fake upstream (recorded responses from
+bench/fixtures) and fresh copies of the app configured through the
+environment, driven in-process over ASGI.
+"""
+import asyncio
+import contextlib
+import importlib.util
+import itertools
+import logging
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+BENCH_DIR = REPO_DIR / "bench"
+# bench/ also carries the yt-dlp plugins for bench.invalid, Instagram and TikTok
+sys.path[:0] = [str(REPO_DIR), str(BENCH_DIR)]
+
+import run as bench  # noqa: E402
+
+_app_ids = itertools.count()
+
+
+@pytest.fixture(scope="session")
+def upstream() -> str:
+    server = bench._start_upstream(0)
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+@pytest.fixture
+def load_app(upstream, monkeypatch, tmp_path):
+    """
+    Import a fresh copy of main.py with `env` on top of the bench defaults.
+    Settings are read at import, so every call is an independent app instance
+    (as if it were another worker) with its own caches and limiter.
+    """
+    names = []
+
+    def load(**env):
+        settings = {
+            "BENCH_UPSTREAM_URL": upstream,
+            "INSTAGRAM_BASE_URL": upstream,
+            "TIKTOK_BASE_URL": upstream,
+            "EXTRACT_RATE_LIMIT": "1000/minute",
+            "STATE_BACKEND": "memory://",
+            "LINK_INDEX_PATH": str(tmp_path / f"links-{next(_app_ids)}.sqlite3"),
+            **env,
+        }
+        for key, value in settings.items():
+            monkeypatch.setenv(key, value)
+        name = f"main_under_test_{next(_app_ids)}"
+        spec = importlib.util.spec_from_file_location(name, REPO_DIR / "main.py")
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        names.append(name)
+        spec.loader.exec_module(module)
+        return module
+
+    logging.disable(logging.WARNING)
+    yield load
+    logging.disable(logging.NOTSET)
+    for name in names:
+        sys.modules.pop(name, None)
+
+
+@pytest.fixture
+def serve():
+    """`async with serve(main) as client`: an httpx client on a started, ready app."""
+    return _serve
+
+
+@contextlib.asynccontextmanager
+async def _serve(main):
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), \
+            httpx.AsyncClient(transport=transport, base_url="http://test", timeout=None) as client:
+        while (await client.get("/ready")).status_code != 200:
+            await asyncio.sleep(0.05)
+        yield client
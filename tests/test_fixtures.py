@@ -0,0 +1,110 @@
+"""
+/extract against the recorded upstream responses in bench/fixtures: each
+platform path must return the media the fixture actually holds.
+"""
+import asyncio
+
+import pytest
+
+from conftest import BENCH_DIR
+
+FIXTURES = BENCH_DIR / "fixtures"
+
+CAROUSEL_URLS = [
+    f"https://scontent.cdninstagram.com/v/t51.29350-15/bench_{i}_1080.jpg"
+    f"?stp=dst-jpg_e35&_nc_ht=scontent.cdninstagram.com&oe=7FFFFFFF"
+    for i in (1, 2, 3)
+]
+# The page's JSON blob carries the same images without the _nc_ht param
+CAROUSEL_PAGE_URLS = [
+    f"https://scontent.cdninstagram.com/v/t51.29350-15/bench_{i}_1080.jpg?stp=dst-jpg_e35&oe=7FFFFFFF"
+    for i in (1, 2, 3)
+]
+REEL_URL = "https://scontent.cdninstagram.com/o1/v/t16/f2/m86/bench_reel_720.mp4?efg=bench&oe=7FFFFFFF"
+
+
+def _extract(load_app, serve, url: str, **env) -> dict:
+    main = load_app(**env)
+
+    async def go():
+        async with serve(main) as client:
+            resp = await client.post("/extract", json={"url": url})
+            assert resp.status_code == 200, resp.text
+            return resp.json()
+
+    return asyncio.run(go())
+
+
+def test_instagram_carousel_fast_path(load_app, serve):
+    result = _extract(load_app, serve, "https://www.instagram.com/p/POST000001/")
+    assert result["served_by"] == "instagram_post"
+    assert result["media_type"] == "image"
+    assert result["title"] == "Benchmark carousel post"
+    # Largest candidate of each of the three carousel items, in order
+    assert result["media_urls"] == CAROUSEL_URLS
+    assert result["direct_url"] == CAROUSEL_URLS[0]
+    assert len(result["stream_urls"]) == 3
+
+
+def test_instagram_carousel_page_race(load_app, serve):
+    # yt-dlp gets nothing for the post, so the API/page race serves it
+    result = _extract(load_app, serve, "https://www.instagram.com/p/POST000002/", FAST_PATHS="none")
+    assert result["media_type"] == "image"
+    assert len(result["media_urls"]) == 3
+    assert result["media_urls"] in (CAROUSEL_URLS, CAROUSEL_PAGE_URLS)
+
+
+def test_instagram_reel(load_app, serve):
+    result = _extract(load_app, serve, "https://www.instagram.com/reel/REEL000001/")
+    assert result["media_type"] == "video"
+    assert result["ext"] == "mp4"
+    assert result["title"] == "Benchmark reel"
+    # The 720p rendition, not the 480p one or the cover image
+    assert result["media_urls"] == [REEL_URL]
+    assert result["direct_url"] == REEL_URL
+
+
+def test_tiktok_video(load_app, serve):
+    result = _extract(load_app, serve, "https://www.tiktok.com/@bench/video/7300000000000000001")
+    assert result["served_by"] == "tiktok_web"
+    assert result["media_type"] == "video"
+    assert result["title"] == "Benchmark TikTok video bench"
+    assert len(result["media_urls"]) == 1
+    assert result["direct_url"].startswith(
+        "https://v16-webapp-prime.tiktok.com/video/tos/maliva/tos-maliva-ve-0068c799/bench/?"
+    )
+    assert "expire=4102444800" in result["direct_url"]
+    # The CDN wants the page's referer along with the URL
+    assert result["headers"]["Referer"] == "https://www.tiktok.com/"
+
+
+def test_ytdlp_video_picks_progressive_hd(load_app, serve):
+    result = _extract(load_app, serve, "https://bench.invalid/video/v000001")
+    assert result["served_by"] == "extract_info"
+    assert result["title"] == "Benchmark video"
+    assert result["direct_url"] == "https://media.bench.invalid/progressive/hd.mp4?expire=4102444800"
+
+
+def test_ytdlp_carousel_keeps_every_entry(load_app, serve):
+    result = _extract(load_app, serve, "https://bench.invalid/carousel/c000001")
+    assert result["media_urls"] == [
+        "https://media.bench.invalid/carousel/1.jpg?expire=4102444800",
+        "https://media.bench.invalid/carousel/2-hd.mp4?expire=4102444800",
+        "https://media.bench.invalid/carousel/3.jpg?expire=4102444800",
+        "https://media.bench.invalid/carousel/4.jpg?expire=4102444800",
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", [64, 1024, 1 << 20])
+def test_scanner_reads_carousel_page(load_app, chunk_size):
+    main = load_app()
+    page = (FIXTURES / "instagram_post.html").read_text()
+    scanner = main._MediaUrlScanner()
+    for start in range(0, len(page), chunk_size):
+        if scanner.feed(page[start:start + chunk_size]):
+            break
+    result = scanner.result()
+    assert scanner.expected == 3
+    assert "Benchmark carousel post" in result["title"]
+    assert result["media_urls"] == CAROUSEL_PAGE_URLS
+
@@ -0,0 +1,99 @@
+"""
+Two app instances sharing STATE_BACKEND on the in-process RESP stand-in
+(bench/resp_stub.py), as two workers would share one Redis.
+"""
+import asyncio
+import time
+
+import pytest
+
+from resp_stub import start_resp_stub
+
+
+@pytest.fixture
+def resp_stub():
+    server = start_resp_stub()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def two_apps(load_app, resp_stub):
+    def load(**env):
+        url = f"redis://127.0.0.1:{resp_stub.server_address[1]}/0"
+        return load_app(STATE_BACKEND=url, **env), load_app(STATE_BACKEND=url, **env)
+    return load
+
+
+def test_rate_limit_is_shared(two_apps, serve, resp_stub):
+    first, second = two_apps(EXTRACT_RATE_LIMIT="3/minute")
+
+    async def go():
+        async with serve(first) as a, serve(second) as b:
+            statuses = []
+            for i, client in enumerate((a, b, a, b)):
+                resp = await client.post("/extract", json={"url": f"https://bench.invalid/video/limit{i}"})
+                statuses.append(resp.status_code)
+            return statuses
+
+    # Each instance alone has only spent two of its three
+    assert asyncio.run(go()) == [200, 200, 200, 429]
+    # Counted on the backend, not in the limiter's in-memory fallback
+    assert any(key.startswith(b"limit:") for key in resp_stub.data)
+
+
+def test_extraction_cache_writes_through(two_apps, serve, resp_stub):
+    first, second = two_apps()
+    url = "https://bench.invalid/video/shared"
+
+    async def go():
+        async with serve(first) as a, serve(second) as b:
+            fresh = (await a.post("/extract", json={"url": url})).json()
+            keys = [key for key in resp_stub.data if key.startswith(b"extract:")]
+            shared = (await b.post("/extract", json={"url": url})).json()
+            return fresh, keys, shared
+
+    fresh, keys, shared = asyncio.run(go())
+    assert fresh["served_by"] == "extract_info"
+    assert len(keys) == 1
+    # The second instance never extracted: it read the first one's entry
+    assert shared["served_by"] == "cache"
+    assert shared["direct_url"] == fresh["direct_url"]
+    assert second.extraction_cache.shared_hits == 1
+
+
+def test_set_nx_px_expiry(two_apps):
+    first, second = two_apps()
+
+    assert first.state_backend.set_default("test:nx", "first", 0.2) == "first"
+    # NX: the second writer gets the stored value back, not its own
+    assert second.state_backend.set_default("test:nx", "second", 0.2) == "first"
+    assert 0 < second.state_backend.expires_at("test:nx") - time.time() <= 0.2
+    # The counter's window starts with its first hit and is not extended after
+    assert first.state_backend.incr("test:count", 1, 0.2) == 1
+    assert second.state_backend.incr("test:count", 2, 60) == 3
+    assert second.state_backend.expires_at("test:count") - time.time() <= 0.2
+
+    time.sleep(0.3)
+    assert first.state_backend.get("test:nx") is None
+    assert first.state_backend.expires_at("test:count") is None
+    assert second.state_backend.set_default("test:nx", "second", 0.2) == "second"
+    assert second.state_backend.incr("test:count", 1, 0.2) == 1
+
+
+def test_job_is_visible_from_another_instance(two_apps, serve):
+    first, second = two_apps()
+
+    async def go():
+        async with serve(first) as a, serve(second) as b:
+            created = (await a.post("/jobs", json={"url": "https://bench.invalid/video/job"})).json()
+            while (await a.get(created["status_url"])).json()["status"] not in ("succeeded", "failed"):
+                await asyncio.sleep(0.05)
+            return (await b.get(created["status_url"])).json(), (await b.get("/jobs/unknown")).status_code
+
+    job, missing = asyncio.run(go())
+    assert job["status"] == "succeeded"
+    assert job["result"]["title"] == "Benchmark video"
+    assert job["stages"]
+    assert missing == 404